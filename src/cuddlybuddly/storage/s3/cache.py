@@ -1,8 +1,68 @@
+from collections import OrderedDict
 import hashlib
 import os
+import sqlite3
+import tempfile
+import threading
+import time
 from django.conf import settings
+from django.core.cache import get_cache
 from django.core.exceptions import ImproperlyConfigured
-from django.utils.encoding import smart_str
+from django.utils.encoding import smart_str, smart_unicode
+from django.utils.importlib import import_module
+
+
+# Default for arguments where None is a meaningful value of its own.
+_SETTING = object()
+
+
+def import_cache_class(import_path):
+    """
+    Returns the cache class at import_path, e.g.
+    ``cuddlybuddly.storage.s3.cache.FileSystemCache``.
+    """
+    try:
+        dot = import_path.rindex('.')
+    except ValueError:
+        raise ImproperlyConfigured("%s isn't a cache module." % import_path)
+    module, classname = import_path[:dot], import_path[dot+1:]
+    try:
+        mod = import_module(module)
+    except ImportError, e:
+        raise ImproperlyConfigured('Error importing cache module %s: "%s"' % (module, e))
+    try:
+        return getattr(mod, classname)
+    except AttributeError:
+        raise ImproperlyConfigured('Cache module "%s" does not define a "%s" class.' % (module, classname))
+
+
+def write_atomically(path, contents):
+    """
+    Writes contents to a temporary file next to path and renames it into
+    place, so that path is never seen half written.
+    """
+    dirname = os.path.dirname(path)
+    if not os.path.exists(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            # Created by another process in the meantime.
+            if not os.path.isdir(dirname):
+                raise
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+    try:
+        try:
+            os.write(fd, contents)
+        finally:
+            os.close(fd)
+        if os.name == 'nt' and os.path.exists(path):
+            # Windows won't rename over an existing file.
+            os.remove(path)
+        os.rename(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
 
 
 class Cache(object):
@@ -49,9 +109,64 @@ class Cache(object):
         """
         raise NotImplementedError()
 
+    def save_missing(self, name):
+        """
+        Record that name doesn't exist so that exists() can return False for
+        the next ``missing_timeout`` seconds. Caches that can't do this just
+        ignore it.
+        """
+        pass
+
+    @property
+    def missing_timeout(self):
+        return getattr(settings, 'CUDDLYBUDDLY_STORAGE_S3_MISSING_TIMEOUT', 60)
+
+    def get_many(self, names):
+        """
+        Returns a dict of each name found in the cache to a tuple of its size
+        and modified time.
+        """
+        found = {}
+        for name in names:
+            size = self.size(name)
+            mtime = self.modified_time(name)
+            if size is not None and mtime is not None:
+                found[name] = (size, mtime)
+        return found
+
+    def save_many(self, entries):
+        """
+        Save the values for a dict of names to tuples of size and modified
+        time.
+        """
+        for name, (size, mtime) in entries.items():
+            self.save(name, size, mtime)
+
+    def remove_many(self, names):
+        """
+        Remove the values for all of names from the cache.
+        """
+        for name in names:
+            self.remove(name)
+
 
 class FileSystemCache(Cache):
-    def __init__(self, cache_dir=None):
+    """
+    Stores one small file per entry, spread over two levels of
+    subdirectories named after the start of the hash of the name.
+
+    Entries are written to a temporary file and renamed into place so they
+    are never seen half written, and each is parsed at most once per write
+    within a process.
+    """
+
+    # Written in place of the size for files known not to exist, followed by
+    # when that stops being true.
+    MISSING = 'missing'
+    # The number of parsed entries remembered before starting again.
+    max_memo_entries = 10000
+
+    def __init__(self, cache_dir=None, memoize=True):
         if cache_dir is None:
             cache_dir = getattr(settings, 'CUDDLYBUDDLY_STORAGE_S3_FILE_CACHE_DIR', None)
             if cache_dir is None:
@@ -59,39 +174,509 @@ class FileSystemCache(Cache):
                     '%s requires CUDDLYBUDDLY_STORAGE_S3_FILE_CACHE_DIR to be set to a directory.' % type(self)
                 )
         self.cache_dir = cache_dir
+        self.memoize = memoize
+        self._memo = {}
+        self._lock = threading.Lock()
 
     def _path(self, name):
-        return os.path.join(self.cache_dir, hashlib.md5(smart_str(name)).hexdigest())
+        digest = hashlib.md5(smart_str(name)).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest[2:4], digest)
+
+    def _read(self, name):
+        """
+        Returns a tuple of size and modified time, a tuple of MISSING and
+        when it expires or None if there is no entry.
+        """
+        path = self._path(name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        # Every write renames a new file into place, so a matching inode
+        # means the entry hasn't changed since it was last parsed.
+        key = (stat.st_ino, stat.st_mtime, stat.st_size)
+        memo = self._memo.get(path)
+        if memo is not None and memo[0] == key:
+            record = memo[1]
+        else:
+            try:
+                file = open(path)
+                try:
+                    lines = file.read().split('\n')
+                finally:
+                    file.close()
+                if lines[1] == self.MISSING:
+                    record = (self.MISSING, float(lines[2]))
+                else:
+                    record = (int(lines[1]), float(lines[2]))
+            except (IOError, IndexError, ValueError):
+                return None
+            if self.memoize:
+                self._lock.acquire()
+                try:
+                    if len(self._memo) >= self.max_memo_entries:
+                        self._memo.clear()
+                    self._memo[path] = (key, record)
+                finally:
+                    self._lock.release()
+        if record[0] == self.MISSING and record[1] < time.time():
+            return None
+        return record
+
+    def _write(self, name, contents):
+        write_atomically(self._path(name), smart_str(name)+'\n'+contents)
 
     def exists(self, name):
+        record = self._read(name)
+        if record is None:
+            return None
+        return record[0] != self.MISSING
+
+    def size(self, name):
+        record = self._read(name)
+        if record is None or record[0] == self.MISSING:
+            return None
+        return record[0]
+
+    def modified_time(self, name):
+        record = self._read(name)
+        if record is None or record[0] == self.MISSING:
+            return None
+        return record[1]
+
+    def save(self, name, size, mtime):
+        self._write(name, str(size)+'\n'+repr(float(mtime)))
+
+    def save_missing(self, name):
+        self._write(name, self.MISSING+'\n'+repr(time.time() + self.missing_timeout))
+
+    def remove(self, name):
+        path = self._path(name)
+        if os.path.exists(path):
+            os.remove(path)
+        self._lock.acquire()
+        try:
+            self._memo.pop(path, None)
+        finally:
+            self._lock.release()
+
+
+class SQLiteCache(Cache):
+    """
+    Stores the cache in an indexed SQLite table, which copes with millions
+    of entries, can be read by many processes at once and can be searched by
+    prefix.
+    """
+
+    # SQLite's default limit on the number of variables in a query is 999.
+    batch_size = 500
+
+    def __init__(self, path=None):
+        if path is None:
+            path = getattr(settings, 'CUDDLYBUDDLY_STORAGE_S3_SQLITE_CACHE_PATH', None)
+            if path is None:
+                raise ImproperlyConfigured(
+                    '%s requires CUDDLYBUDDLY_STORAGE_S3_SQLITE_CACHE_PATH to be set to a file.' % type(self)
+                )
+        self.path = path
+        self._local = threading.local()
+
+    @property
+    def db(self):
+        # SQLite connections can't be shared between threads.
+        if not hasattr(self._local, 'db'):
+            dirname = os.path.dirname(self.path)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS entries ('
+                'name TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime REAL NOT NULL)'
+            )
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS missing ('
+                'name TEXT PRIMARY KEY, expires REAL NOT NULL)'
+            )
+            self._local.db = db
+        return self._local.db
+
+    def _get(self, name):
+        return self.db.execute(
+            'SELECT size, mtime FROM entries WHERE name = ?', (smart_unicode(name),)
+        ).fetchone()
+
+    def exists(self, name):
+        if self._get(name) is not None:
+            return True
+        row = self.db.execute(
+            'SELECT 1 FROM missing WHERE name = ? AND expires > ?',
+            (smart_unicode(name), time.time())
+        ).fetchone()
+        if row is not None:
+            return False
         return None
 
     def size(self, name):
+        row = self._get(name)
+        return row and row[0]
+
+    def modified_time(self, name):
+        row = self._get(name)
+        return row and row[1]
+
+    def save(self, name, size, mtime):
+        self.db.execute(
+            'INSERT OR REPLACE INTO entries (name, size, mtime) VALUES (?, ?, ?)',
+            (smart_unicode(name), size, mtime)
+        )
+
+    def remove(self, name):
+        self.db.execute('DELETE FROM entries WHERE name = ?', (smart_unicode(name),))
+        self.db.execute('DELETE FROM missing WHERE name = ?', (smart_unicode(name),))
+
+    def save_missing(self, name):
+        name = smart_unicode(name)
+        db = self.db
+        db.execute('BEGIN')
         try:
-            file = open(self._path(name))
-            size = int(file.readlines()[1])
-            file.close()
+            db.execute('DELETE FROM entries WHERE name = ?', (name,))
+            db.execute(
+                'INSERT OR REPLACE INTO missing (name, expires) VALUES (?, ?)',
+                (name, time.time() + self.missing_timeout)
+            )
         except:
-            size = None
-        return size
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
 
-    def modified_time(self, name):
+    def get_many(self, names):
+        names = dict((smart_unicode(name), name) for name in names)
+        keys = names.keys()
+        found = {}
+        for i in range(0, len(keys), self.batch_size):
+            batch = keys[i:i + self.batch_size]
+            rows = self.db.execute(
+                'SELECT name, size, mtime FROM entries WHERE name IN (%s)'
+                    % ', '.join('?' * len(batch)),
+                batch
+            )
+            for name, size, mtime in rows:
+                found[names[name]] = (size, mtime)
+        return found
+
+    def save_many(self, entries):
+        db = self.db
+        db.execute('BEGIN')
+        try:
+            db.executemany(
+                'INSERT OR REPLACE INTO entries (name, size, mtime) VALUES (?, ?, ?)',
+                ((smart_unicode(name), size, mtime)
+                 for name, (size, mtime) in entries.iteritems())
+            )
+        except:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def remove_many(self, names):
+        db = self.db
+        db.execute('BEGIN')
         try:
-            file = open(self._path(name))
-            mtime = float(file.readlines()[2])
-            file.close()
+            names = [(smart_unicode(name),) for name in names]
+            db.executemany('DELETE FROM entries WHERE name = ?', names)
+            db.executemany('DELETE FROM missing WHERE name = ?', names)
         except:
-            mtime = None
-        return mtime
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def iter_prefix(self, prefix):
+        """
+        Yields a tuple of name, size and modified time for every entry whose
+        name starts with prefix, in order.
+        """
+        prefix = smart_unicode(prefix)
+        # A range rather than LIKE so that the primary key index is used.
+        rows = self.db.execute(
+            'SELECT name, size, mtime FROM entries WHERE name >= ? AND name < ? ORDER BY name',
+            (prefix, prefix + u'\U0010ffff')
+        )
+        for row in rows:
+            yield row
+
+
+class DjangoCache(Cache):
+    """
+    Stores the cache with Django's cache framework so that it can be shared
+    between servers through memcached, redis, etc.
+
+    Each file is one value in the cache, holding whether it exists along with
+    its size and modified time.
+    """
+
+    def __init__(self, alias=None, timeout=None, key_prefix='cbs3'):
+        if alias is None:
+            alias = getattr(settings, 'CUDDLYBUDDLY_STORAGE_S3_DJANGO_CACHE', 'default')
+        if timeout is None:
+            timeout = getattr(settings, 'CUDDLYBUDDLY_STORAGE_S3_DJANGO_CACHE_TIMEOUT', None)
+        self.cache = get_cache(alias)
+        self.timeout = timeout
+        self.key_prefix = key_prefix
+
+    def _key(self, name):
+        # Hashed so that names are always valid memcached keys.
+        return '%s:%s' % (self.key_prefix, hashlib.md5(smart_str(name)).hexdigest())
+
+    def _get(self, name):
+        value = self.cache.get(self._key(name))
+        if value is None or not value[0]:
+            return None
+        return value
+
+    def exists(self, name):
+        value = self.cache.get(self._key(name))
+        return value and value[0]
+
+    def size(self, name):
+        value = self._get(name)
+        return value and value[1]
+
+    def modified_time(self, name):
+        value = self._get(name)
+        return value and value[2]
+
+    def save(self, name, size, mtime):
+        self.cache.set(self._key(name), (True, size, mtime), self.timeout)
+
+    def remove(self, name):
+        self.cache.delete(self._key(name))
+
+    def save_missing(self, name):
+        self.cache.set(self._key(name), (False, None, None), self.missing_timeout)
+
+    def get_many(self, names):
+        keys = dict((self._key(name), name) for name in names)
+        found = {}
+        for key, value in self.cache.get_many(keys.keys()).items():
+            if value is not None and value[0]:
+                found[keys[key]] = (value[1], value[2])
+        return found
+
+    def save_many(self, entries):
+        self.cache.set_many(dict(
+            (self._key(name), (True, size, mtime))
+            for name, (size, mtime) in entries.items()
+        ), self.timeout)
+
+
+class MemoryCache(Cache):
+    """
+    A thread safe, in process cache that holds a limited number of entries
+    and throws away the least recently used ones first.
+
+    Another cache can be given as ``backend`` (an instance or an import
+    path) in which case this is used as a first level cache in front of it.
+    ``timeout`` and ``backend`` come from the settings unless given, and
+    either can be given as None to turn it off.
+    """
+
+    def __init__(self, max_entries=None, timeout=_SETTING, backend=_SETTING):
+        if max_entries is None:
+            max_entries = getattr(settings, 'CUDDLYBUDDLY_STORAGE_S3_MEMORY_CACHE_MAX_ENTRIES', 10000)
+        if timeout is _SETTING:
+            timeout = getattr(settings, 'CUDDLYBUDDLY_STORAGE_S3_MEMORY_CACHE_TIMEOUT', None)
+        if backend is _SETTING:
+            backend = getattr(settings, 'CUDDLYBUDDLY_STORAGE_S3_MEMORY_CACHE_BACKEND', None)
+        if isinstance(backend, basestring):
+            backend = import_cache_class(backend)()
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.backend = backend
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, name):
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(name, None)
+            if entry is not None:
+                if entry[2] is not None and entry[2] < time.time():
+                    entry = None
+                else:
+                    # Move it to the most recently used end.
+                    self._entries[name] = entry
+        finally:
+            self._lock.release()
+        if entry is None and self.backend is not None:
+            size = self.backend.size(name)
+            mtime = self.backend.modified_time(name)
+            if size is not None and mtime is not None:
+                entry = self._set(name, size, mtime)
+        return entry
+
+    def _set(self, name, size, mtime, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        expires = None
+        if timeout is not None:
+            expires = time.time() + timeout
+        entry = (size, mtime, expires)
+        self._lock.acquire()
+        try:
+            self._entries.pop(name, None)
+            self._entries[name] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        finally:
+            self._lock.release()
+        return entry
+
+    def exists(self, name):
+        entry = self._get(name)
+        if entry is not None:
+            # Missing files are stored with a size of None.
+            return entry[0] is not None
+        if self.backend is not None:
+            return self.backend.exists(name)
+        return None
+
+    def size(self, name):
+        entry = self._get(name)
+        return entry and entry[0]
+
+    def modified_time(self, name):
+        entry = self._get(name)
+        return entry and entry[1]
 
     def save(self, name, size, mtime):
-        if not os.path.exists(self.cache_dir):
-            os.makedirs(self.cache_dir)
-        file = open(self._path(name), 'w')
-        file.write(smart_str(name)+'\n'+str(size)+'\n'+str(mtime))
-        file.close()
+        self._set(name, size, mtime)
+        if self.backend is not None:
+            self.backend.save(name, size, mtime)
+
+    def save_missing(self, name):
+        self._set(name, None, None, self.missing_timeout)
+        if self.backend is not None:
+            self.backend.save_missing(name)
 
     def remove(self, name):
-        name = self._path(name)
-        if os.path.exists(name):
-            os.remove(name)
+        self._lock.acquire()
+        try:
+            self._entries.pop(name, None)
+        finally:
+            self._lock.release()
+        if self.backend is not None:
+            self.backend.remove(name)
+
+
+class FileSystemContentCache(object):
+    """
+    Keeps local copies of the contents of small files along with their
+    etags, so that reading them again only needs a conditional request.
+
+    Once the cache grows past ``max_size`` bytes the least recently used
+    files are removed. The size of the cache is kept as a running total
+    that is only checked against the files on disk when it goes over, so
+    other processes sharing the directory can take it over briefly.
+    """
+
+    def __init__(self, cache_dir=None, max_size=None, max_file_size=None):
+        if cache_dir is None:
+            cache_dir = getattr(settings, 'CUDDLYBUDDLY_STORAGE_S3_CONTENT_CACHE_DIR', None)
+            if cache_dir is None:
+                raise ImproperlyConfigured(
+                    '%s requires CUDDLYBUDDLY_STORAGE_S3_CONTENT_CACHE_DIR to be set to a directory.' % type(self)
+                )
+        if max_size is None:
+            max_size = getattr(settings, 'CUDDLYBUDDLY_STORAGE_S3_CONTENT_CACHE_MAX_SIZE', 100 * 2**20)
+        if max_file_size is None:
+            max_file_size = getattr(settings, 'CUDDLYBUDDLY_STORAGE_S3_CONTENT_CACHE_MAX_FILE_SIZE', 2**20)
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.max_file_size = max_file_size
+        self._lock = threading.Lock()
+        # Unknown until the first save.
+        self._total = None
+
+    def _path(self, name):
+        return os.path.join(self.cache_dir, hashlib.md5(smart_str(name)).hexdigest())
+
+    def get(self, name):
+        """
+        Returns a tuple of the etag and contents of name, or None if it
+        isn't cached.
+        """
+        path = self._path(name)
+        try:
+            file = open(path, 'rb')
+            try:
+                etag, data = file.read().split('\n', 1)
+            finally:
+                file.close()
+            # The modified time is used to find the least recently used files.
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return etag, data
+
+    def save(self, name, etag, data):
+        if len(data) > self.max_file_size:
+            return
+        path = self._path(name)
+        contents = smart_str(etag) + '\n' + data
+        old_size = self._file_size(path)
+        write_atomically(path, contents)
+        self._add_to_total(len(contents) - old_size)
+        if self._total is None or self._total > self.max_size:
+            self._evict()
+
+    def remove(self, name):
+        path = self._path(name)
+        size = self._file_size(path)
+        if size:
+            try:
+                os.remove(path)
+            except OSError:
+                return
+            self._add_to_total(-size)
+
+    def _file_size(self, path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    def _add_to_total(self, size):
+        self._lock.acquire()
+        try:
+            if self._total is not None:
+                self._total += size
+        finally:
+            self._lock.release()
+
+    def _evict(self):
+        self._lock.acquire()
+        try:
+            files, total = [], 0
+            for filename in os.listdir(self.cache_dir):
+                if filename.endswith('.tmp'):
+                    continue
+                path = os.path.join(self.cache_dir, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+            files.sort()
+            while total > self.max_size and files:
+                mtime, size, path = files.pop(0)
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+            self._total = total
+        finally:
+            self._lock.release()
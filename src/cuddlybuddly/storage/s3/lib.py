@@ -24,20 +24,44 @@
 #
 #  2011/03/07 - Changed all uses of urlquote_plus to urlquote.
 #
+#  Added ConnectionPool so connections are kept alive between requests.
+#
+#  Added get_stream and StreamingGetResponse for reading objects in chunks.
+#
+#  Added multipart upload support.
+#
+#  Added ListParser.ETREE for parsing bucket listings with cElementTree.
+#
+#  Added delete_multiple for the Multi-Object Delete API.
+#
+#  Added copy and upload_part_copy for server side copies.
+#
+#  Added RetryPolicy so failed requests are retried with backoff.
+#
 #  (c) 2009-2011 Kyle MacFarlane
 
 import base64
 import hmac
 import httplib
 import hashlib
+import random
+import socket
+import threading
 import time
 import urlparse
 import xml.sax
+from xml.sax.saxutils import escape
+import zlib
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
 from django.utils.http import urlquote
 
 DEFAULT_HOST = 's3.amazonaws.com'
 PORTS_BY_SECURITY = { True: 443, False: 80 }
 METADATA_PREFIX = 'x-amz-meta-'
+DEFAULT_CHUNK_SIZE = 64 * 2**10
 AMAZON_HEADER_PREFIX = 'x-amz-'
 
 class S3Exception(Exception):
@@ -93,6 +117,15 @@ def canonical_string(method, bucket="", key="", query_args={}, headers={}, expir
         buf += "?logging"
     elif "location" in query_args:
         buf += "?location"
+    elif "uploads" in query_args:
+        buf += "?uploads"
+    elif "delete" in query_args:
+        buf += "?delete"
+    elif "uploadId" in query_args:
+        buf += "?"
+        if "partNumber" in query_args:
+            buf += "partNumber=%s&" % query_args["partNumber"]
+        buf += "uploadId=%s" % query_args["uploadId"]
 
     return buf
 
@@ -112,6 +145,20 @@ def merge_meta(headers, metadata):
 
     return final_headers
 
+# pops the x-amz-meta- headers out of the response headers
+def get_aws_metadata(headers):
+    metadata = {}
+    for hkey in headers.keys():
+        if hkey.lower().startswith(METADATA_PREFIX):
+            metadata[hkey[len(METADATA_PREFIX):]] = headers[hkey]
+            del headers[hkey]
+
+    return metadata
+
+# the value of the x-amz-copy-source header
+def copy_source(bucket, key):
+    return urlquote("/%s/%s" % (bucket, key), '/')
+
 # builds the query arg string
 def query_args_hash_to_string(query_args):
     query_string = ""
@@ -125,6 +172,145 @@ def query_args_hash_to_string(query_args):
     return '&'.join(pairs)
 
 
+class ConnectionPool(object):
+    """
+    A thread safe pool of keep-alive connections, keyed by host.
+
+    A connection is handed back to the pool as soon as its response has been
+    received, but it isn't reused until that response has been read to the
+    end. Connections idle for longer than ``idle_timeout`` seconds are closed
+    instead of being reused, and ones whose response still hasn't been read
+    by then are forgotten, so an abandoned response doesn't hold a place in
+    the pool forever.
+    """
+
+    def __init__(self, max_size=10, idle_timeout=60):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._connections = {}
+
+    def get(self, is_secure, host):
+        """
+        Returns a tuple of a connection to ``host`` and whether or not it is a
+        reused connection.
+        """
+        key = (is_secure, host)
+        now = time.time()
+        self._lock.acquire()
+        try:
+            entries = self._expire(self._connections.get(key, []), now)
+            for entry in list(entries):
+                connection, response, last_used = entry
+                if response is not None and not response.isclosed():
+                    # Still being read by someone else.
+                    continue
+                entries.remove(entry)
+                if response is not None and response.will_close:
+                    connection.close()
+                    continue
+                return connection, True
+        finally:
+            self._lock.release()
+        return self.connect(is_secure, host), False
+
+    def _expire(self, entries, now):
+        """
+        Removes the entries in ``entries`` that have been in the pool for
+        longer than ``idle_timeout`` seconds. Must be called with the lock
+        held.
+        """
+        for entry in list(entries):
+            connection, response, last_used = entry
+            if now - last_used <= self.idle_timeout:
+                continue
+            entries.remove(entry)
+            # Closing the connection would also close a response that is
+            # still being read, so that is left to whoever holds it.
+            if response is None or response.isclosed():
+                connection.close()
+        return entries
+
+    def connect(self, is_secure, host):
+        """
+        Returns a new connection to ``host``, bypassing the pool.
+        """
+        if is_secure:
+            return httplib.HTTPSConnection(host)
+        return httplib.HTTPConnection(host)
+
+    def put(self, is_secure, host, connection, response=None):
+        """
+        Returns ``connection`` to the pool once ``response`` has been read.
+        """
+        if response is not None and response.will_close:
+            return
+        key = (is_secure, host)
+        now = time.time()
+        self._lock.acquire()
+        try:
+            entries = self._expire(self._connections.setdefault(key, []), now)
+            if len(entries) < self.max_size:
+                entries.append((connection, response, now))
+        finally:
+            self._lock.release()
+
+
+class RetryPolicy(object):
+    """
+    Decides whether a request that failed with a server error or a broken
+    connection is tried again. Each retry waits a random time of up to
+    ``backoff * 2**n`` seconds, capped at ``max_backoff``, so that clients
+    throttled at the same time don't all come back at once.
+
+    Only idempotent requests are retried, which are those with an idempotent
+    method or a POST to an idempotent subresource like ``?delete``, and only
+    when the body can be sent again, i.e. it is a string or a file that can
+    be rewound. ``retries`` counts the retries made and ``failures`` the
+    requests that still failed after ``max_attempts`` attempts.
+    """
+
+    RETRY_STATUSES = (500, 502, 503, 504)
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
+    IDEMPOTENT_SUBRESOURCES = ('delete',)
+
+    def __init__(self, max_attempts=3, backoff=0.1, max_backoff=20):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retries = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def can_retry(self, method, data, query_args={}):
+        if method not in self.IDEMPOTENT_METHODS and not \
+           [arg for arg in self.IDEMPOTENT_SUBRESOURCES if arg in query_args]:
+            return False
+        return isinstance(data, basestring) or \
+            (hasattr(data, 'seek') and hasattr(data, 'tell'))
+
+    def retry(self, attempt):
+        """
+        Returns whether to try again after attempt failed, counting either
+        the retry or the failure.
+        """
+        self._lock.acquire()
+        try:
+            if attempt >= self.max_attempts:
+                self.failures += 1
+                return False
+            self.retries += 1
+            return True
+        finally:
+            self._lock.release()
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2**(attempt - 1)))
+
+    def wait(self, attempt):
+        time.sleep(self.delay(attempt))
+
+
 class CallingFormat:
     PATH = 1
     SUBDOMAIN = 2
@@ -154,6 +340,12 @@ class CallingFormat:
 
 
 
+class ListParser:
+    SAX = 1
+    ETREE = 2
+
+
+
 class Location:
     DEFAULT = None
     EU = 'EU'
@@ -162,7 +354,8 @@ class Location:
 
 class AWSAuthConnection:
     def __init__(self, aws_access_key_id, aws_secret_access_key, is_secure=True,
-            server=DEFAULT_HOST, port=None, calling_format=CallingFormat.SUBDOMAIN):
+            server=DEFAULT_HOST, port=None, calling_format=CallingFormat.SUBDOMAIN,
+            pool=None, list_parser=ListParser.SAX, retry_policy=None):
 
         if not port:
             port = PORTS_BY_SECURITY[is_secure]
@@ -173,6 +366,13 @@ class AWSAuthConnection:
         self.server = server
         self.port = port
         self.calling_format = calling_format
+        if pool is None:
+            pool = ConnectionPool()
+        self.pool = pool
+        self.list_parser = list_parser
+        if retry_policy is None:
+            retry_policy = RetryPolicy()
+        self.retry_policy = retry_policy
 
     def create_bucket(self, bucket, headers={}):
         return Response(self._make_request('PUT', bucket, '', {}, headers))
@@ -190,7 +390,9 @@ class AWSAuthConnection:
         return self._make_request('HEAD', bucket, '', {}, {})
 
     def list_bucket(self, bucket, options={}, headers={}):
-        return ListBucketResponse(self._make_request('GET', bucket, '', options, headers))
+        return ListBucketResponse(
+                self._make_request('GET', bucket, '', options, headers),
+                self.list_parser)
 
     def delete_bucket(self, bucket, headers={}):
         return Response(self._make_request('DELETE', bucket, '', {}, headers))
@@ -213,10 +415,117 @@ class AWSAuthConnection:
         return GetResponse(
                 self._make_request('GET', bucket, key, {}, headers))
 
+    def get_stream(self, bucket, key, headers={}, decode_gzip=True):
+        return StreamingGetResponse(
+                self._make_request('GET', bucket, key, {}, headers),
+                decode_gzip)
+
+    # the metadata of the source is kept unless new metadata is given
+    def copy(self, source_bucket, source_key, bucket, key, headers={}, metadata=None):
+        final_headers = headers.copy()
+        final_headers['x-amz-copy-source'] = copy_source(source_bucket, source_key)
+        if metadata is None:
+            final_headers['x-amz-metadata-directive'] = 'COPY'
+            metadata = {}
+        else:
+            final_headers['x-amz-metadata-directive'] = 'REPLACE'
+        return CopyObjectResponse(
+                self._make_request(
+                    'PUT',
+                    bucket,
+                    key,
+                    {},
+                    final_headers,
+                    '',
+                    metadata))
+
     def delete(self, bucket, key, headers={}):
         return Response(
                 self._make_request('DELETE', bucket, key, {}, headers))
 
+    def initiate_multipart_upload(self, bucket, key, headers={}, metadata={}):
+        return InitiateMultipartUploadResponse(
+                self._make_request(
+                    'POST',
+                    bucket,
+                    key,
+                    { 'uploads': None },
+                    headers,
+                    '',
+                    metadata))
+
+    def upload_part(self, bucket, key, upload_id, part_number, data, headers={}):
+        return Response(
+                self._make_request(
+                    'PUT',
+                    bucket,
+                    key,
+                    { 'partNumber': part_number, 'uploadId': upload_id },
+                    headers,
+                    data))
+
+    # copies the byte range start to end inclusive of another object
+    def upload_part_copy(self, bucket, key, upload_id, part_number, source_bucket,
+                         source_key, start, end, headers={}):
+        final_headers = headers.copy()
+        final_headers['x-amz-copy-source'] = copy_source(source_bucket, source_key)
+        final_headers['x-amz-copy-source-range'] = 'bytes=%d-%d' % (start, end)
+        return CopyObjectResponse(
+                self._make_request(
+                    'PUT',
+                    bucket,
+                    key,
+                    { 'partNumber': part_number, 'uploadId': upload_id },
+                    final_headers))
+
+    # parts is a list of (part_number, etag) tuples
+    def complete_multipart_upload(self, bucket, key, upload_id, parts, headers={}):
+        body = "<CompleteMultipartUpload>"
+        for part_number, etag in sorted(parts):
+            body += "<Part><PartNumber>%d</PartNumber><ETag>%s</ETag></Part>" % \
+                    (part_number, etag)
+        body += "</CompleteMultipartUpload>"
+        return CompleteMultipartUploadResponse(
+                self._make_request(
+                    'POST',
+                    bucket,
+                    key,
+                    { 'uploadId': upload_id },
+                    headers,
+                    body))
+
+    def abort_multipart_upload(self, bucket, key, upload_id, headers={}):
+        return Response(
+                self._make_request(
+                    'DELETE',
+                    bucket,
+                    key,
+                    { 'uploadId': upload_id },
+                    headers))
+
+    # deletes up to 1000 keys in one request. in quiet mode only the keys that
+    # couldn't be deleted are reported.
+    def delete_multiple(self, bucket, keys, quiet=True, headers={}):
+        body = "<Delete>"
+        if quiet:
+            body += "<Quiet>true</Quiet>"
+        for key in keys:
+            if isinstance(key, unicode):
+                key = key.encode('utf-8')
+            body += "<Object><Key>%s</Key></Object>" % escape(key)
+        body += "</Delete>"
+        final_headers = headers.copy()
+        final_headers['Content-MD5'] = base64.b64encode(hashlib.md5(body).digest())
+        final_headers['Content-Type'] = 'application/xml'
+        return DeleteMultipleResponse(
+                self._make_request(
+                    'POST',
+                    bucket,
+                    '',
+                    { 'delete': None },
+                    final_headers,
+                    body))
+
     def get_bucket_logging(self, bucket, headers={}):
         return GetResponse(self._make_request('GET', bucket, '', { 'logging': None }, headers))
 
@@ -280,18 +589,34 @@ class AWSAuthConnection:
 
         is_secure = self.is_secure
         host = "%s:%d" % (server, self.port)
+        data_pos = None
+        if hasattr(data, 'seek') and hasattr(data, 'tell'):
+            data_pos = data.tell()
+        can_retry = self.retry_policy.can_retry(method, data, query_args)
+        attempt = 0
         while True:
-            if (is_secure):
-                connection = httplib.HTTPSConnection(host)
-            else:
-                connection = httplib.HTTPConnection(host)
-
+            attempt += 1
             final_headers = merge_meta(headers, metadata);
             # add auth header
             self._add_aws_auth_header(final_headers, method, bucket, key, query_args)
 
-            connection.request(method, path, data, final_headers)
-            resp = connection.getresponse()
+            try:
+                resp = self._send(is_secure, host, method, path, data, final_headers)
+            except (httplib.HTTPException, socket.error):
+                if not (can_retry and self.retry_policy.retry(attempt)):
+                    raise
+                self.retry_policy.wait(attempt)
+                if data_pos is not None:
+                    data.seek(data_pos)
+                continue
+            if resp.status in self.retry_policy.RETRY_STATUSES and can_retry \
+               and self.retry_policy.retry(attempt):
+                # (close connection)
+                resp.read()
+                self.retry_policy.wait(attempt)
+                if data_pos is not None:
+                    data.seek(data_pos)
+                continue
             if resp.status < 300 or resp.status >= 400:
                 return resp
             # handle redirect
@@ -308,6 +633,32 @@ class AWSAuthConnection:
             if query: path += "?" + query
             # retry with redirect
 
+    def _send(self, is_secure, host, method, path, data, headers):
+        data_pos = None
+        if hasattr(data, 'seek') and hasattr(data, 'tell'):
+            data_pos = data.tell()
+        connection, reused = self.pool.get(is_secure, host)
+        try:
+            connection.request(method, path, data, headers)
+            resp = connection.getresponse()
+        except (httplib.HTTPException, socket.error):
+            connection.close()
+            # The server may have dropped an idle keep-alive connection, so
+            # try again once on a fresh one.
+            if not reused:
+                raise
+            if data_pos is not None:
+                data.seek(data_pos)
+            connection = self.pool.connect(is_secure, host)
+            connection.request(method, path, data, headers)
+            resp = connection.getresponse()
+        if method == 'HEAD':
+            # There is no body, but reading marks the response as finished
+            # so that the connection can be reused.
+            resp.read()
+        self.pool.put(is_secure, host, connection, resp)
+        return resp
+
     def _add_aws_auth_header(self, headers, method, bucket, key, query_args):
         if not 'Date' in headers:
             headers['Date'] = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime())
@@ -448,8 +799,22 @@ class ListEntry:
         self.storage_class = storage_class
         self.owner = owner
 
+class CompactListEntry(object):
+    """
+    A ListEntry with __slots__, used by parse_list_bucket.
+    """
+    __slots__ = ('key', 'last_modified', 'etag', 'size', 'storage_class', 'owner')
+
+    def __init__(self, key='', last_modified=None, etag='', size=0, storage_class='', owner=None):
+        self.key = key
+        self.last_modified = last_modified
+        self.etag = etag
+        self.size = size
+        self.storage_class = storage_class
+        self.owner = owner
+
 class CommonPrefixEntry:
-    def __init(self, prefix=''):
+    def __init__(self, prefix=''):
         self.prefix = prefix
 
 class Bucket:
@@ -471,11 +836,14 @@ class Response:
 
 
 class ListBucketResponse(Response):
-    def __init__(self, http_response):
+    def __init__(self, http_response, parser=ListParser.SAX):
         Response.__init__(self, http_response)
         if http_response.status < 300:
-            handler = ListBucketHandler()
-            xml.sax.parseString(self.body, handler)
+            if parser == ListParser.ETREE:
+                handler = parse_list_bucket(self.body)
+            else:
+                handler = ListBucketHandler()
+                xml.sax.parseString(self.body, handler)
             self.entries = handler.entries
             self.common_prefixes = handler.common_prefixes
             self.name = handler.name
@@ -487,6 +855,7 @@ class ListBucketResponse(Response):
             self.next_marker = handler.next_marker
         else:
             self.entries = []
+            self.common_prefixes = []
 
 class ListAllMyBucketsResponse(Response):
     def __init__(self, http_response):
@@ -506,13 +875,134 @@ class GetResponse(Response):
         self.object = S3Object(self.body, metadata)
 
     def get_aws_metadata(self, headers):
-        metadata = {}
-        for hkey in headers.keys():
-            if hkey.lower().startswith(METADATA_PREFIX):
-                metadata[hkey[len(METADATA_PREFIX):]] = headers[hkey]
-                del headers[hkey]
+        return get_aws_metadata(headers)
+
+class InitiateMultipartUploadResponse(Response):
+    def __init__(self, http_response):
+        Response.__init__(self, http_response)
+        if http_response.status < 300:
+            handler = InitiateMultipartUploadHandler()
+            xml.sax.parseString(self.body, handler)
+            self.upload_id = handler.upload_id
+        else:
+            self.upload_id = None
+
+class CompleteMultipartUploadResponse(Response):
+    def __init__(self, http_response):
+        Response.__init__(self, http_response)
+        # Errors can happen after the 200 has been sent, in which case they
+        # are only reported in the body.
+        self.is_error = http_response.status >= 300 or '<Error>' in self.body
+        if self.is_error and http_response.status < 300:
+            self.message = self.body
+
+class CopyObjectResponse(Response):
+    def __init__(self, http_response):
+        Response.__init__(self, http_response)
+        # Like completing a multipart upload, a copy can fail after the 200
+        # has been sent.
+        self.is_error = http_response.status >= 300 or '<Error>' in self.body
+        self.etag = self.last_modified = None
+        if self.is_error:
+            if http_response.status < 300:
+                self.message = self.body
+        else:
+            root = ElementTree.fromstring(self.body)
+            ns = ''
+            if root.tag.startswith('{'):
+                ns = root.tag[:root.tag.index('}') + 1]
+            self.etag = root.findtext(ns + 'ETag')
+            self.last_modified = root.findtext(ns + 'LastModified')
+
+class DeleteMultipleResponse(Response):
+    def __init__(self, http_response):
+        Response.__init__(self, http_response)
+        self.deleted = []
+        # tuples of key, code and message
+        self.errors = []
+        if http_response.status < 300:
+            root = ElementTree.fromstring(self.body)
+            ns = ''
+            if root.tag.startswith('{'):
+                ns = root.tag[:root.tag.index('}') + 1]
+            for elem in root.findall(ns + 'Deleted'):
+                self.deleted.append(elem.findtext(ns + 'Key', ''))
+            for elem in root.findall(ns + 'Error'):
+                self.errors.append((
+                    elem.findtext(ns + 'Key', ''),
+                    elem.findtext(ns + 'Code', ''),
+                    elem.findtext(ns + 'Message', '')))
+
+class StreamingGetResponse(object):
+    """
+    Like GetResponse but the body is left on the socket to be read with
+    read() or by iterating over it in chunks. Gzipped bodies are decompressed
+    as they are read unless decode_gzip is False.
+
+    Error bodies are still read in full so that message is useful.
+    """
+
+    def __init__(self, http_response, decode_gzip=True):
+        self.http_response = http_response
+        self.metadata = get_aws_metadata(http_response.msg)
+        self._decompressor = None
+        self._buffer = ''
+        self._eof = False
+        if http_response.status >= 300:
+            self._buffer = http_response.read()
+            self._eof = True
+            if self._buffer:
+                self.message = self._buffer
+            else:
+                self.message = "%03d %s" % (http_response.status, http_response.reason)
+        else:
+            self.message = "%03d %s" % (http_response.status, http_response.reason)
+            if decode_gzip and \
+               http_response.getheader('Content-Encoding') == 'gzip':
+                self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def _read_raw(self, amt):
+        if self._eof:
+            return ''
+        data = self.http_response.read(amt)
+        if not data:
+            self._eof = True
+            if self._decompressor is not None:
+                return self._decompressor.flush()
+            return ''
+        if self._decompressor is not None:
+            data = self._decompressor.decompress(data)
+        return data
+
+    def read(self, amt=None):
+        if amt is None:
+            chunks = [self._buffer]
+            while not self._eof:
+                chunks.append(self._read_raw(DEFAULT_CHUNK_SIZE))
+            self._buffer = ''
+            return ''.join(chunks)
+        while len(self._buffer) < amt and not self._eof:
+            self._buffer += self._read_raw(max(amt, DEFAULT_CHUNK_SIZE))
+        data, self._buffer = self._buffer[:amt], self._buffer[amt:]
+        return data
+
+    def iter_chunks(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        while True:
+            data = self.read(chunk_size)
+            if not data:
+                break
+            yield data
+
+    def __iter__(self):
+        return self.iter_chunks()
+
+    def close(self):
+        if not self._eof:
+            # The rest of the body is still waiting on the socket so the
+            # connection can't be used for anything else.
+            self.http_response.will_close = True
+        self.http_response.close()
 
-        return metadata
 
 class LocationResponse(Response):
     def __init__(self, http_response):
@@ -590,6 +1080,65 @@ class ListBucketHandler(xml.sax.ContentHandler):
         self.curr_text += content
 
 
+class ListBucketResult(object):
+    def __init__(self):
+        self.entries = []
+        self.common_prefixes = []
+        self.name = ''
+        self.marker = ''
+        self.prefix = ''
+        self.is_truncated = False
+        self.delimiter = ''
+        self.max_keys = 0
+        self.next_marker = ''
+
+# a faster alternative to ListBucketHandler that leaves the parsing to
+# cElementTree. each key becomes a CompactListEntry and the Owner of every
+# key is shared when the ids match.
+def parse_list_bucket(body):
+    root = ElementTree.fromstring(body)
+    ns = ''
+    if root.tag.startswith('{'):
+        ns = root.tag[:root.tag.index('}') + 1]
+    result = ListBucketResult()
+    owners = {}
+    key_tag, last_modified_tag, etag_tag, size_tag, storage_class_tag, \
+        owner_tag, id_tag, display_name_tag, prefix_tag = [ns + tag for tag in (
+            'Key', 'LastModified', 'ETag', 'Size', 'StorageClass', 'Owner',
+            'ID', 'DisplayName', 'Prefix')]
+
+    for elem in root.findall(ns + 'Contents'):
+        entry = CompactListEntry(
+            elem.findtext(key_tag, ''),
+            elem.findtext(last_modified_tag),
+            elem.findtext(etag_tag, ''),
+            int(elem.findtext(size_tag, 0)),
+            elem.findtext(storage_class_tag, ''))
+        owner_elem = elem.find(owner_tag)
+        if owner_elem is not None:
+            owner_key = (owner_elem.findtext(id_tag, ''),
+                         owner_elem.findtext(display_name_tag, ''))
+            owner = owners.get(owner_key)
+            if owner is None:
+                owner = owners[owner_key] = Owner(*owner_key)
+            entry.owner = owner
+        result.entries.append(entry)
+
+    for elem in root.findall(ns + 'CommonPrefixes'):
+        result.common_prefixes.append(
+            CommonPrefixEntry(elem.findtext(prefix_tag, '')))
+
+    result.name = root.findtext(ns + 'Name', '')
+    result.prefix = root.findtext(prefix_tag, '')
+    result.marker = root.findtext(ns + 'Marker', '')
+    result.is_truncated = root.findtext(ns + 'IsTruncated') == 'true'
+    result.delimiter = root.findtext(ns + 'Delimiter', '')
+    result.max_keys = int(root.findtext(ns + 'MaxKeys', 0))
+    result.next_marker = root.findtext(ns + 'NextMarker', '')
+
+    return result
+
+
 class ListAllMyBucketsHandler(xml.sax.ContentHandler):
     def __init__(self):
         self.entries = []
@@ -612,6 +1161,22 @@ class ListAllMyBucketsHandler(xml.sax.ContentHandler):
         self.curr_text = content
 
 
+class InitiateMultipartUploadHandler(xml.sax.ContentHandler):
+    def __init__(self):
+        self.upload_id = None
+        self.curr_text = ''
+
+    def startElement(self, name, attrs):
+        self.curr_text = ''
+
+    def endElement(self, name):
+        if name == 'UploadId':
+            self.upload_id = self.curr_text
+
+    def characters(self, content):
+        self.curr_text += content
+
+
 class LocationHandler(xml.sax.ContentHandler):
     def __init__(self):
         self.location = None
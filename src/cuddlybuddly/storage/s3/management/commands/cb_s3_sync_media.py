@@ -1,12 +1,20 @@
 from datetime import datetime
+import hashlib
+from itertools import imap
+import json
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from optparse import make_option
 import os
 import re
 import sys
+import threading
 from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.utils.encoding import smart_unicode
 from cuddlybuddly.storage.s3.exceptions import S3Error
-from cuddlybuddly.storage.s3.storage import S3Storage
+from cuddlybuddly.storage.s3.lib import METADATA_PREFIX
+from cuddlybuddly.storage.s3.storage import S3Storage, parse_iso8601
 
 
 output_length = 0
@@ -51,6 +59,53 @@ def walk(dir, options):
     return to_sync
 
 
+def file_md5(path):
+    md5 = hashlib.md5()
+    fh = open(path, 'rb')
+    try:
+        for data in iter(lambda: fh.read(64 * 2**10), ''):
+            md5.update(data)
+    finally:
+        fh.close()
+    return md5.hexdigest()
+
+
+def hash_files(files):
+    """
+    Returns a dict of each file to the MD5 of its contents, hashing large
+    numbers of files in a pool of processes.
+    """
+    if len(files) < 100:
+        return dict(zip(files, map(file_md5, files)))
+    pool = Pool()
+    try:
+        return dict(zip(files, pool.map(file_md5, files, chunksize=32)))
+    finally:
+        pool.terminate()
+
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {}
+    fh = open(path, 'rb')
+    try:
+        return json.load(fh)
+    finally:
+        fh.close()
+
+
+def save_manifest(path, manifest):
+    # Written to a temporary file first so a failed sync can't leave behind
+    # a truncated manifest.
+    tmp_path = '%s.tmp' % path
+    fh = open(tmp_path, 'wb')
+    try:
+        json.dump(manifest, fh, indent=0, sort_keys=True)
+    finally:
+        fh.close()
+    os.rename(tmp_path, path)
+
+
 class Command(BaseCommand):
     help = 'Sync folder with your S3 bucket'
     option_list = BaseCommand.option_list + (
@@ -76,14 +131,118 @@ class Command(BaseCommand):
             dest='force',
             default=False,
             help='Upload all files even if the version on S3 is up to date'),
+        make_option('-H', '--hash',
+            action='store_true',
+            dest='hash',
+            default=False,
+            help='Compare MD5 hashes of the contents instead of modified times'),
+        make_option('-l', '--list',
+            action='store_true',
+            dest='list',
+            default=False,
+            help='List the bucket once instead of checking each file with its own request'),
+        make_option('-m', '--manifest',
+            action='store',
+            dest='manifest',
+            type='string',
+            default=None,
+            help='A file to store the hashes of uploaded files in for use with --hash'),
         make_option('-p', '--prefix',
             action='store',
             dest='prefix',
             type='string',
             default='',
             help='Prefix to prepend to uploaded files'),
+        make_option('-w', '--workers',
+            action='store',
+            dest='workers',
+            type='int',
+            default=1,
+            help='Number of files to check and upload at the same time'),
     )
 
+    def get_storage(self):
+        # S3Storage isn't shared between threads so that each worker has its
+        # own connections.
+        if not hasattr(self._local, 'storage'):
+            self._local.storage = S3Storage()
+        return self._local.storage
+
+    def list_bucket(self, prefix):
+        """
+        Returns a dict of every key under prefix to a tuple of its size, last
+        modified timestamp and etag, following the listing a page at a time.
+        """
+        index = {}
+        for entry in self.get_storage().iter_keys(prefix):
+            index[entry.key] = (
+                entry.size,
+                parse_iso8601(entry.last_modified),
+                entry.etag
+            )
+        return index
+
+    def stored_md5(self, key):
+        """
+        Returns the MD5 of the original file saved with key when it was
+        uploaded, or None.
+        """
+        storage = self.get_storage()
+        response = storage.connection._make_request('HEAD', storage.bucket, key)
+        if response.status != 200:
+            return None
+        return response.getheader(METADATA_PREFIX + 'md5')
+
+    def sync_file(self, file, options):
+        """
+        Uploads file if needed and returns a tuple of its name in the bucket
+        and whether or not it was uploaded.
+        """
+        storage = self.get_storage()
+        s3name = os.path.join(
+            options['prefix'],
+            os.path.relpath(file, options['dir'])
+        )
+        key = smart_unicode(storage._path(s3name))
+        if options['hash']:
+            remote_md5 = None
+            if self.manifest is not None:
+                remote_md5 = self.manifest.get(key)
+            elif self.index is not None:
+                entry = self.index.get(key)
+                remote_md5 = entry and entry[2].strip('"')
+                # The etag of gzipped and multipart uploads isn't the MD5 of
+                # the file, so check the MD5 saved with the upload instead.
+                if entry and remote_md5 != self.hashes[file]:
+                    remote_md5 = self.stored_md5(key)
+            modified = remote_md5 != self.hashes[file]
+        else:
+            if self.index is not None:
+                entry = self.index.get(key)
+                mtime = entry and datetime.fromtimestamp(entry[1])
+            else:
+                try:
+                    mtime = storage.modified_time(s3name, force_check=not options['cache'])
+                except S3Error:
+                    mtime = None
+            modified = mtime is None or \
+                mtime < datetime.fromtimestamp(os.path.getmtime(file))
+        if options['force'] or modified:
+            fh = open(file, 'rb')
+            if options['workers'] == 1:
+                output(' Uploading %s...' % s3name, options)
+            metadata = None
+            if options['hash']:
+                metadata = {'md5': self.hashes[file]}
+            storage.overwrite(s3name, fh, metadata)
+            fh.close()
+            uploaded = True
+        else:
+            uploaded = False
+        if self.new_manifest is not None:
+            self.new_manifest[key] = self.hashes[file]
+        return s3name, uploaded
+
     def handle(self, *args, **options):
         if options['dir'] is None:
             options['dir'] = settings.MEDIA_ROOT
@@ -107,39 +266,53 @@ class Command(BaseCommand):
             options,
             rtrn=True # Needed to correctly calculate padding
         )
-        storage = S3Storage()
-        for file in files:
-            s3name = os.path.join(
-                options['prefix'],
-                os.path.relpath(file, options['dir'])
-            )
-            try:
-                mtime = storage.modified_time(s3name, force_check=not options['cache'])
-            except S3Error:
-                mtime = None
-            if options['force'] or mtime is None or \
-               mtime < datetime.fromtimestamp(os.path.getmtime(file)):
-                if mtime:
-                    storage.delete(s3name)
-                fh = open(file, 'rb')
-                output(' Uploading %s...' % s3name, options)
-                storage.save(s3name, fh)
-                output('Uploaded %s' % s3name, options, rtrn=True, nl=True)
-                fh.close()
-                uploaded += 1
-            else:
+        self._local = threading.local()
+        options['workers'] = max(1, int(options.get('workers') or 1))
+        self.index = self.manifest = self.new_manifest = self.hashes = None
+        if options.get('hash'):
+            self.hashes = hash_files(files)
+            if options.get('manifest'):
+                self.manifest = load_manifest(options['manifest'])
+                self.new_manifest = dict(self.manifest)
+        else:
+            options['hash'] = False
+        # Without a manifest the hashes are compared to the etags in the
+        # listing.
+        if (options.get('list') or (options['hash'] and self.manifest is None)) \
+           and not options['force']:
+            self.index = self.list_bucket(options['prefix'])
+        sync_file = lambda file: self.sync_file(file, options)
+        if options['workers'] > 1:
+            pool = ThreadPool(options['workers'])
+            results = pool.imap_unordered(sync_file, files)
+        else:
+            pool = None
+            results = imap(sync_file, files)
+        try:
+            # Output only happens here, in the main thread, so the counts
+            # stay accurate however many workers there are.
+            for s3name, was_uploaded in results:
+                if was_uploaded:
+                    output('Uploaded %s' % s3name, options, rtrn=True, nl=True)
+                    uploaded += 1
+                else:
+                    output(
+                        'Skipped %s because it hasn\'t been modified' % s3name,
+                        options,
+                        min_verbosity=2,
+                        rtrn=True,
+                        nl=True
+                    )
+                    skipped += 1
                 output(
-                    'Skipped %s because it hasn\'t been modified' % s3name,
+                    'Uploaded: %s, Skipped: %s, Total: %s/%s'
+                        % (uploaded, skipped, uploaded + skipped, len(files)),
                     options,
-                    min_verbosity=2,
-                    rtrn=True,
-                    nl=True
+                    rtrn=True
                 )
-                skipped += 1
-            output(
-                'Uploaded: %s, Skipped: %s, Total: %s/%s'
-                    % (uploaded, skipped, uploaded + skipped, len(files)),
-                options,
-                rtrn=True
-            )
+        finally:
+            if pool is not None:
+                pool.terminate()
+            if self.new_manifest is not None:
+                save_manifest(options['manifest'], self.new_manifest)
         output('', options, nl=True)
@@ -0,0 +1,23 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from cuddlybuddly.storage.s3.storage import S3Storage
+
+
+class Command(BaseCommand):
+    help = 'Fill the metadata cache from a listing of your S3 bucket'
+    option_list = BaseCommand.option_list + (
+        make_option('-p', '--prefix',
+            action='store',
+            dest='prefix',
+            type='string',
+            default='',
+            help='Only cache files starting with this prefix'),
+    )
+
+    def handle(self, *args, **options):
+        storage = S3Storage()
+        if not storage.cache:
+            raise CommandError('CUDDLYBUDDLY_STORAGE_S3_CACHE is not set.')
+        count = storage.warm_cache(options['prefix'])
+        if int(options['verbosity']) >= 1:
+            self.stdout.write('Cached %s files\n' % count)
@@ -1,28 +1,51 @@
 from calendar import timegm
+from collections import OrderedDict
 from datetime import datetime
 from email.utils import parsedate
 from gzip import GzipFile
+import math
 import mimetypes
+from multiprocessing.pool import ThreadPool
 import os
+import posixpath
 import re
 from StringIO import StringIO # Don't use cStringIO as it's not unicode safe
 import sys
+from tempfile import SpooledTemporaryFile
+import threading
 from urlparse import urljoin
+import zlib
 from django.conf import settings
-from django.core.exceptions import ImproperlyConfigured
 from django.core.files.base import File
 from django.core.files.storage import Storage
-from django.utils.encoding import iri_to_uri
-from django.utils.importlib import import_module
+from django.utils.encoding import iri_to_uri, smart_str, smart_unicode
 from cuddlybuddly.storage.s3 import CallingFormat
+from cuddlybuddly.storage.s3.cache import import_cache_class
 from cuddlybuddly.storage.s3.exceptions import S3Error
-from cuddlybuddly.storage.s3.lib import AWSAuthConnection
+from cuddlybuddly.storage.s3.lib import AWSAuthConnection, CommonPrefixEntry, \
+    ConnectionPool, ListParser, RetryPolicy, S3Object, get_aws_metadata
 from cuddlybuddly.storage.s3.middleware import request_is_secure
 
 
 ACCESS_KEY_NAME = 'AWS_ACCESS_KEY_ID'
 SECRET_KEY_NAME = 'AWS_SECRET_ACCESS_KEY'
 HEADERS = 'AWS_HEADERS'
+# S3 rejects parts smaller than this, apart from the last one.
+MIN_PART_SIZE = 5 * 2**20
+# The largest object S3 will copy in a single request.
+MAX_COPY_SIZE = 5 * 2**30
+# Headers that describe an object and are kept when copying it in parts.
+COPIED_HEADERS = ('cache-control', 'content-disposition', 'content-encoding',
+                  'content-language', 'content-type', 'expires')
+GZIP_SAMPLE_SIZE = 64 * 2**10
+
+
+def parse_iso8601(value):
+    """
+    Converts a timestamp from a bucket listing, e.g.
+    ``2009-10-12T17:50:30.000Z``, to seconds since the epoch.
+    """
+    return timegm(datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S').timetuple())
 
 
 class S3Storage(Storage):
@@ -31,7 +54,8 @@ class S3Storage(Storage):
     static = False
 
     def __init__(self, bucket=None, access_key=None, secret_key=None,
-                 headers=None, calling_format=None, cache=None, base_url=None):
+                 headers=None, calling_format=None, cache=None, base_url=None,
+                 content_cache=None):
         if bucket is None:
             bucket = settings.AWS_STORAGE_BUCKET_NAME
         if calling_format is None:
@@ -42,8 +66,19 @@ class S3Storage(Storage):
         if not access_key and not secret_key:
             access_key, secret_key = self._get_access_keys()
 
+        self.pool = ConnectionPool(
+            max_size=getattr(settings, 'CUDDLYBUDDLY_STORAGE_S3_POOL_SIZE', 10),
+            idle_timeout=getattr(settings, 'CUDDLYBUDDLY_STORAGE_S3_POOL_TIMEOUT', 60)
+        )
+        self.retry_policy = RetryPolicy(
+            max_attempts=getattr(settings, 'CUDDLYBUDDLY_STORAGE_S3_RETRY_ATTEMPTS', 3),
+            backoff=getattr(settings, 'CUDDLYBUDDLY_STORAGE_S3_RETRY_BACKOFF', 0.1),
+            max_backoff=getattr(settings, 'CUDDLYBUDDLY_STORAGE_S3_RETRY_MAX_BACKOFF', 20)
+        )
         self.connection = AWSAuthConnection(access_key, secret_key,
-                            calling_format=calling_format)
+                            calling_format=calling_format, pool=self.pool,
+                            list_parser=ListParser.ETREE,
+                            retry_policy=self.retry_policy)
 
         default_headers = getattr(settings, HEADERS, [])
         # Backwards compatibility for original format from django-storages
@@ -66,6 +101,19 @@ class S3Storage(Storage):
             else:
                 self.cache = None
 
+        if content_cache is not None:
+            self.content_cache = content_cache
+        else:
+            content_cache = getattr(settings, 'CUDDLYBUDDLY_STORAGE_S3_CONTENT_CACHE', None)
+            if content_cache is not None:
+                self.content_cache = self._get_cache_class(content_cache)()
+            else:
+                self.content_cache = None
+
+        # Started the first time a method is run in the background.
+        self._async_pool = None
+        self._async_lock = threading.Lock()
+
         if base_url is None:
             if not self.static:
                 base_url = settings.MEDIA_URL
@@ -74,19 +122,7 @@ class S3Storage(Storage):
         self.base_url = base_url
 
     def _get_cache_class(self, import_path=None):
-        try:
-            dot = import_path.rindex('.')
-        except ValueError:
-            raise ImproperlyConfigured("%s isn't a cache module." % import_path)
-        module, classname = import_path[:dot], import_path[dot+1:]
-        try:
-            mod = import_module(module)
-        except ImportError, e:
-            raise ImproperlyConfigured('Error importing cache module %s: "%s"' % (module, e))
-        try:
-            return getattr(mod, classname)
-        except AttributeError:
-            raise ImproperlyConfigured('Cache module "%s" does not define a "%s" class.' % (module, classname))
+        return import_cache_class(import_path)
 
     def _store_in_cache(self, name, response):
         size = int(response.getheader('Content-Length'))
@@ -94,6 +130,12 @@ class S3Storage(Storage):
         date = timegm(parsedate(date))
         self.cache.save(name, size=size, mtime=date)
 
+    def _get_headers(self, name):
+        for pattern in self.headers:
+            if pattern[0].match(name):
+                return pattern[1].copy()
+        return {}
+
     def _get_access_keys(self):
         access_key = getattr(settings, ACCESS_KEY_NAME, None)
         secret_key = getattr(settings, SECRET_KEY_NAME, None)
@@ -108,21 +150,19 @@ class S3Storage(Storage):
         return None, None
 
     def _get_connection(self):
-        return AWSAuthConnection(*self._get_access_keys())
+        return AWSAuthConnection(*self._get_access_keys(), pool=self.pool,
+                                 retry_policy=self.retry_policy)
 
-    def _put_file(self, name, content):
+    def _put_file(self, name, content, metadata=None):
         name = self._path(name)
         placeholder = False
         if self.cache:
+            # Also replaces any entry saying the file is missing.
             if not self.cache.exists(name):
                 self.cache.save(name, 0, 0)
-                placedholder = True
+                placeholder = True
         content_type = mimetypes.guess_type(name)[0] or "application/x-octet-stream"
-        headers = {}
-        for pattern in self.headers:
-            if pattern[0].match(name):
-                headers = pattern[1].copy()
-                break
+        headers = self._get_headers(name)
         file_pos = content.tell()
         content.seek(0, 2)
         content_length = content.tell()
@@ -138,48 +178,234 @@ class S3Storage(Storage):
         )
         gz_content = None
         if content_length > 1024 and content_type in gz_cts:
-            gz_content = StringIO()
-            gzf = GzipFile(mode='wb', fileobj=gz_content)
-            gzf.write(content.read())
+            gz_content = self._compress(content, content_length)
             content.seek(0)
-            gzf.close()
-            gz_content.seek(0, 2)
-            gz_content_length = gz_content.tell()
-            gz_content.seek(0)
-            if gz_content_length < content_length:
-                content_length = gz_content_length
+            if gz_content is not None:
+                gz_content.seek(0, 2)
+                content_length = gz_content.tell()
+                gz_content.seek(0)
                 headers.update({
                     'Content-Encoding': 'gzip'
                 })
-            else:
-                gz_content = None
         headers.update({
             'Content-Type': content_type,
             'Content-Length': str(content_length)
         })
-        # Httplib in < 2.6 doesn't accept file like objects. Meanwhile in
-        # >= 2.7 it will try to join a content str object with the headers which
-        # results in encoding problems.
-        if sys.version_info[0] == 2 and sys.version_info[1] < 6:
-            content_to_send = gz_content.read() if gz_content is not None else content.read()
-        else:
-            content_to_send = gz_content if gz_content is not None else content
-        response = self.connection.put(self.bucket, name, content_to_send, headers)
-        content.seek(file_pos)
-        if response.http_response.status != 200:
-            if placeholder:
-                self.cache.remove(name)
-            raise S3Error(response.message)
+        threshold = getattr(
+            settings,
+            'CUDDLYBUDDLY_STORAGE_S3_MULTIPART_THRESHOLD',
+            64 * 2**20
+        )
+        try:
+            try:
+                if threshold and content_length > threshold:
+                    response = self._put_multipart(
+                        name, gz_content if gz_content is not None else content,
+                        headers, metadata)
+                else:
+                    # Httplib in < 2.6 doesn't accept file like objects.
+                    # Meanwhile in >= 2.7 it will try to join a content str
+                    # object with the headers which results in encoding
+                    # problems.
+                    if sys.version_info[0] == 2 and sys.version_info[1] < 6:
+                        content_to_send = gz_content.read() if gz_content is not None else content.read()
+                    else:
+                        content_to_send = gz_content if gz_content is not None else content
+                    response = self.connection.put(
+                        self.bucket, name, S3Object(content_to_send, metadata or {}),
+                        headers)
+                if response.http_response.status != 200:
+                    raise S3Error(response.message)
+            except Exception:
+                # Don't leave the placeholder saying a file that was never
+                # uploaded exists.
+                if placeholder:
+                    self.cache.remove(name)
+                raise
+        finally:
+            content.seek(file_pos)
+            if gz_content is not None:
+                gz_content.close()
+        if self.content_cache is not None:
+            self.content_cache.remove(name)
         if self.cache:
             date = response.http_response.getheader('Date')
             date = timegm(parsedate(date))
             self.cache.save(name, size=content_length, mtime=date)
 
+    def _compress(self, content, content_length):
+        """
+        Gzips content a chunk at a time into a temporary file that only
+        moves to disk once it gets large. Returns None if gzipping doesn't
+        make content any smaller, which for large files is guessed from a
+        sample of the start of it first to avoid compressing the whole thing
+        for nothing.
+        """
+        if content_length > GZIP_SAMPLE_SIZE:
+            sample = smart_str(content.read(GZIP_SAMPLE_SIZE))
+            content.seek(0)
+            if len(zlib.compress(sample)) >= len(sample) * 0.9:
+                return None
+        gz_content = SpooledTemporaryFile(max_size=getattr(
+            settings,
+            'CUDDLYBUDDLY_STORAGE_S3_WRITE_BUFFER_SIZE',
+            5 * 2**20
+        ))
+        gzf = GzipFile(mode='wb', fileobj=gz_content)
+        while True:
+            data = content.read(GZIP_SAMPLE_SIZE)
+            if not data:
+                break
+            gzf.write(smart_str(data))
+            if gz_content.tell() >= content_length:
+                gz_content.close()
+                return None
+        gzf.close()
+        if gz_content.tell() >= content_length:
+            gz_content.close()
+            return None
+        return gz_content
+
+    def _put_multipart(self, name, content, headers, metadata=None):
+        """
+        Uploads content in parts from a pool of threads.
+        """
+        part_size = max(
+            getattr(settings, 'CUDDLYBUDDLY_STORAGE_S3_MULTIPART_CHUNK_SIZE', 8 * 2**20),
+            MIN_PART_SIZE
+        )
+        headers = dict((k, v) for k, v in headers.items()
+                       if k.lower() != 'content-length')
+        content.seek(0, 2)
+        part_count = max(1, int(math.ceil(content.tell() / float(part_size))))
+        # Only one thread can read from content at a time.
+        lock = threading.Lock()
+
+        def send_part(upload_id, part_number):
+            lock.acquire()
+            try:
+                content.seek((part_number - 1) * part_size)
+                data = content.read(part_size)
+            finally:
+                lock.release()
+            response = self.connection.upload_part(
+                self.bucket, name, upload_id, part_number, data)
+            if response.http_response.status != 200:
+                return response, None
+            return response, response.http_response.getheader('ETag')
+
+        return self._multipart(name, headers, metadata or {}, part_count, send_part)
+
+    def _copy_multipart(self, src, dst, headers, src_response):
+        """
+        Copies src to dst in parts from a pool of threads, for objects too
+        big to copy in one request. Unlike a single copy, the metadata has to
+        be taken from the HEAD response for src and given to the new upload.
+        """
+        size = int(src_response.getheader('Content-Length'))
+        src_headers = dict(src_response.msg.items())
+        metadata = get_aws_metadata(src_headers)
+        headers = headers.copy()
+        for key, value in src_headers.items():
+            if key.lower() in COPIED_HEADERS:
+                headers[key] = value
+        part_size = max(
+            getattr(settings, 'CUDDLYBUDDLY_STORAGE_S3_MULTIPART_COPY_CHUNK_SIZE', 512 * 2**20),
+            MIN_PART_SIZE
+        )
+        part_count = max(1, int(math.ceil(size / float(part_size))))
+
+        def send_part(upload_id, part_number):
+            start = (part_number - 1) * part_size
+            response = self.connection.upload_part_copy(
+                self.bucket, dst, upload_id, part_number, self.bucket, src,
+                start, min(start + part_size, size) - 1)
+            return response, response.etag
+
+        return self._multipart(dst, headers, metadata, part_count, send_part)
+
+    def _multipart(self, name, headers, metadata, part_count, send_part):
+        """
+        Runs a multipart upload of name, calling
+        send_part(upload_id, part_number) for each part from a pool of
+        threads. send_part returns the response and the part's etag, or None
+        if it failed. Parts are already retried by the connection's retry
+        policy, so the whole upload is aborted if any part still fails.
+        """
+        workers = getattr(settings, 'CUDDLYBUDDLY_STORAGE_S3_MULTIPART_WORKERS', 4)
+        response = self.connection.initiate_multipart_upload(
+            self.bucket, name, headers, metadata)
+        if response.upload_id is None:
+            raise S3Error(response.message)
+        upload_id = response.upload_id
+
+        def upload_part(part_number):
+            response, etag = send_part(upload_id, part_number)
+            if etag is None:
+                raise S3Error(response.message)
+            return part_number, etag
+
+        pool = ThreadPool(max(1, min(workers, part_count)))
+        try:
+            try:
+                parts = pool.map(upload_part, range(1, part_count + 1))
+            except Exception:
+                self.connection.abort_multipart_upload(self.bucket, name, upload_id)
+                raise
+        finally:
+            pool.terminate()
+        response = self.connection.complete_multipart_upload(
+            self.bucket, name, upload_id, parts)
+        if response.is_error:
+            self.connection.abort_multipart_upload(self.bucket, name, upload_id)
+            raise S3Error(response.message)
+        return response
+
     def _open(self, name, mode='rb'):
-        remote_file = S3StorageFile(name, self, mode=mode)
-        return remote_file
+        return S3StorageFile(name, self, mode=mode)
 
-    def _read(self, name, start_range=None, end_range=None):
+    def _read_cached(self, name):
+        """
+        Returns the contents of name from the content cache after checking
+        with S3 that it is still current, fetching and caching it if not.
+        Returns None if the file is too big to cache, which callers should
+        check first so that the request isn't wasted.
+        """
+        name = self._path(name)
+        max_file_size = self.content_cache.max_file_size
+        cached = self.content_cache.get(name)
+        # The range stops large files being downloaded just to find out that
+        # they are too big.
+        headers = {'Range': 'bytes=0-%d' % (max_file_size - 1)}
+        if cached is not None:
+            headers['If-None-Match'] = cached[0]
+        response = self.connection.get_stream(self.bucket, name, headers)
+        http_response = response.http_response
+        if http_response.status == 304 and cached is not None:
+            return cached[1]
+        if http_response.status == 206:
+            size = http_response.getheader('content-range').split('/', 1)[1]
+        elif http_response.status == 200:
+            size = http_response.getheader('content-length')
+        else:
+            # Including the 416 for empty files, let the normal reads handle
+            # whatever went wrong.
+            response.close()
+            return None
+        if size is None or int(size) > max_file_size:
+            # The file grew since its size was checked. Closing the partly
+            # read response drops its connection rather than pooling it.
+            response.close()
+            return None
+        data = response.read()
+        self.content_cache.save(name, http_response.getheader('etag'), data)
+        return data
+
+    def _stream(self, name, start_range=None, end_range=None):
+        """
+        Returns a StreamingGetResponse for name with the body still unread,
+        along with the etag and content range headers.
+        """
         name = self._path(name)
         headers, range_ = {}, None
         if start_range is not None and end_range is not None:
@@ -188,26 +414,81 @@ class S3Storage(Storage):
             range_ = '%s' % start_range
         if range_ is not None:
             headers = {'Range': 'bytes=%s' % range_}
-        response = self.connection.get(self.bucket, name, headers)
+        response = self.connection.get_stream(self.bucket, name, headers)
         valid_responses = [200]
         if start_range is not None or end_range is not None:
             valid_responses.append(206)
         if response.http_response.status not in valid_responses:
             raise S3Error(response.message)
         headers = response.http_response.msg
-        data = response.object.data
-
-        if headers.get('Content-Encoding') == 'gzip':
-            gzf = GzipFile(mode='rb', fileobj=StringIO(data))
-            data = gzf.read()
-            gzf.close()
+        return response, headers.get('etag', None), headers.get('content-range', None)
 
-        return data, headers.get('etag', None), headers.get('content-range', None)
+    def _read(self, name, start_range=None, end_range=None):
+        response, etag, content_range = self._stream(name, start_range, end_range)
+        return response.read(), etag, content_range
 
     def _save(self, name, content):
         self._put_file(name, content)
         return name
 
+    def overwrite(self, name, content, metadata=None):
+        """
+        Saves content under exactly name, replacing any existing file in a
+        single request. Unlike save() there are no checks for an available
+        name and the old file is never missing in between. metadata is a
+        dict stored with the file as x-amz-meta- headers.
+        """
+        self._put_file(name, content, metadata)
+        return name
+
+    def copy(self, src, dst):
+        """
+        Copies src to dst within the bucket without the contents ever
+        leaving S3, replacing dst if it exists. Objects over
+        CUDDLYBUDDLY_STORAGE_S3_MULTIPART_COPY_THRESHOLD are copied in parts.
+        Returns dst.
+        """
+        src, dst = self._path(src), self._path(dst)
+        # The ACL isn't copied with the object so it needs setting again.
+        headers = dict((k, v) for k, v in self._get_headers(dst).items()
+                       if k.lower().startswith('x-amz-'))
+        threshold = getattr(
+            settings,
+            'CUDDLYBUDDLY_STORAGE_S3_MULTIPART_COPY_THRESHOLD',
+            MAX_COPY_SIZE
+        )
+        # The size decides how to copy and is saved for dst, so it can't
+        # come from the cache.
+        src_response = self.connection._make_request('HEAD', self.bucket, src)
+        if src_response.status == 404:
+            raise S3Error("Cannot find the file specified: '%s'" % src)
+        if src_response.status != 200:
+            raise S3Error("Cannot stat '%s': %s %s" % (
+                src, src_response.status, src_response.reason))
+        size = int(src_response.getheader('Content-Length'))
+        if threshold and size > threshold:
+            self._copy_multipart(src, dst, headers, src_response)
+            # Completing a multipart upload doesn't report the modified time.
+            stat = self._stat(dst)
+        else:
+            response = self.connection.copy(self.bucket, src, self.bucket, dst, headers)
+            if response.is_error:
+                raise S3Error(response.message)
+            stat = size, parse_iso8601(response.last_modified)
+        if self.content_cache is not None:
+            self.content_cache.remove(dst)
+        if self.cache and stat is not None:
+            self.cache.save(dst, size=stat[0], mtime=stat[1])
+        return dst
+
+    def move(self, src, dst):
+        """
+        Copies src to dst like copy() and then deletes src. Returns dst.
+        """
+        dst = self.copy(src, dst)
+        self.delete(src)
+        return dst
+
     def delete(self, name):
         name = self._path(name)
         response = self.connection.delete(self.bucket, name)
@@ -215,6 +496,32 @@ class S3Storage(Storage):
             raise S3Error(response.message)
         if self.cache:
             self.cache.remove(name)
+        if self.content_cache is not None:
+            self.content_cache.remove(name)
+
+    def delete_many(self, names):
+        """
+        Deletes names with as few requests as possible, up to a thousand at
+        a time. Returns a dict of the names that couldn't be deleted to a
+        tuple of S3's error code and message.
+        """
+        names = [self._path(name) for name in names]
+        errors = {}
+        for i in range(0, len(names), 1000):
+            batch = names[i:i + 1000]
+            response = self.connection.delete_multiple(self.bucket, batch)
+            if response.http_response.status >= 300:
+                raise S3Error(response.message)
+            for key, code, message in response.errors:
+                errors[smart_unicode(key)] = (code, message)
+            deleted = [name for name in batch
+                       if smart_unicode(name) not in errors]
+            if self.cache:
+                self.cache.remove_many(deleted)
+            if self.content_cache is not None:
+                for name in deleted:
+                    self.content_cache.remove(name)
+        return errors
 
     def exists(self, name, force_check=False):
         if not name:
@@ -226,8 +533,11 @@ class S3Storage(Storage):
                 return exists
         response = self.connection._make_request('HEAD', self.bucket, name)
         exists = response.status == 200
-        if self.cache and exists:
-            self._store_in_cache(name, response)
+        if self.cache:
+            if exists:
+                self._store_in_cache(name, response)
+            elif response.status == 404:
+                self.cache.save_missing(name)
         return exists
 
     def size(self, name, force_check=False):
@@ -238,7 +548,7 @@ class S3Storage(Storage):
                 return size
         response = self.connection._make_request('HEAD', self.bucket, name)
         content_length = response.getheader('Content-Length')
-        if self.cache:
+        if self.cache and response.status == 200:
             self._store_in_cache(name, response)
         return content_length and int(content_length) or 0
 
@@ -256,6 +566,106 @@ class S3Storage(Storage):
             self._store_in_cache(name, response)
         return datetime.fromtimestamp(last_modified)
 
+    def _stat(self, name):
+        """
+        Returns a tuple of the size and modified time of name from a HEAD
+        request, or None if it doesn't exist.
+        """
+        response = self.connection._make_request('HEAD', self.bucket, name)
+        if response.status == 404:
+            return None
+        if response.status != 200:
+            raise S3Error("Cannot stat '%s': %s %s" % (name, response.status, response.reason))
+        return (int(response.getheader('Content-Length')),
+                timegm(parsedate(response.getheader('Last-Modified'))))
+
+    def _stat_from_listing(self, names):
+        """
+        Like _stat() for many names at once, from a listing of the keys
+        between the first and last of them. The listing stops after
+        CUDDLYBUDDLY_STORAGE_S3_STAT_LIST_PAGES pages, in which case the
+        names it didn't reach are left out of the result.
+        """
+        max_keys = getattr(settings, 'CUDDLYBUDDLY_STORAGE_S3_STAT_LIST_PAGES', 2) * 1000
+        wanted = dict((smart_unicode(name), name) for name in names)
+        first = min(names, key=smart_str)
+        last = max(smart_str(name) for name in names)
+        # Keys after the marker are listed, so it has to sort before first.
+        entries = self.iter_keys(posixpath.commonprefix(names),
+                                 marker=smart_str(smart_unicode(first)[:-1]))
+        found, reached, complete = {}, None, False
+        for count, entry in enumerate(entries):
+            key = smart_str(entry.key)
+            if key > last:
+                complete = True
+                break
+            if count >= max_keys:
+                break
+            reached = key
+            name = wanted.get(smart_unicode(entry.key))
+            if name is not None:
+                found[name] = (int(entry.size), parse_iso8601(entry.last_modified))
+        else:
+            complete = True
+        for name in names:
+            if name not in found and \
+               (complete or (reached is not None and smart_str(name) <= reached)):
+                found[name] = None
+        return found
+
+    def _stat_concurrently(self, names):
+        """
+        Like _stat() for many names at once, from HEAD requests sent by a
+        pool of threads.
+        """
+        workers = getattr(settings, 'CUDDLYBUDDLY_STORAGE_S3_STAT_WORKERS', 10)
+        pool = ThreadPool(max(1, min(workers, len(names))))
+        try:
+            return dict(zip(names, pool.map(self._stat, names)))
+        finally:
+            pool.terminate()
+
+    def stat_many(self, names, force_check=False):
+        """
+        Returns a dict of each of names to a tuple of its size and modified
+        time as a datetime, or None if it doesn't exist. Names in the cache
+        are looked up together and the rest are then fetched with a single
+        listing if they are all in the same directory, or with HEAD requests
+        from a pool of threads if not or if the listing is too long. The
+        cache is updated with the results.
+        """
+        paths = dict((self._path(name), name) for name in names)
+        stats = {}
+        if self.cache and not force_check:
+            stats = dict((path, stat) for path, stat
+                         in self.cache.get_many(paths.keys()).items() if stat[1])
+            for path in paths:
+                if path not in stats and self.cache.exists(path) is False:
+                    stats[path] = None
+        misses = [path for path in paths if path not in stats]
+        threshold = getattr(settings, 'CUDDLYBUDDLY_STORAGE_S3_STAT_LIST_THRESHOLD', 10)
+        fetched = {}
+        if len(misses) >= threshold and \
+           len(set(posixpath.dirname(path) for path in misses)) == 1:
+            fetched = self._stat_from_listing(misses)
+            misses = [path for path in misses if path not in fetched]
+        if misses:
+            fetched.update(self._stat_concurrently(misses))
+        if self.cache:
+            self.cache.save_many(dict((path, stat) for path, stat
+                                      in fetched.items() if stat is not None))
+            for path, stat in fetched.items():
+                if stat is None:
+                    self.cache.save_missing(path)
+        stats.update(fetched)
+        result = {}
+        for path, name in paths.items():
+            stat = stats[path]
+            if stat is not None:
+                stat = (stat[0], datetime.fromtimestamp(stat[1]))
+            result[name] = stat
+        return result
+
     def url(self, name):
         if self.base_url is None:
             raise ValueError("This file is not accessible via a URL.")
@@ -277,19 +687,114 @@ class S3Storage(Storage):
             url = url.replace('https://', 'http://')
         return urljoin(url, iri_to_uri(name))
 
+    def iter_keys(self, prefix='', delimiter=None, marker=''):
+        """
+        Lazily yields a ``ListEntry`` for every key starting with prefix,
+        requesting the listing a page at a time. If a delimiter is given then
+        a ``CommonPrefixEntry`` is also yielded for each common prefix. If a
+        marker is given then the listing starts after it.
+        """
+        prefix = self._path(prefix)
+        while True:
+            options = {'prefix': prefix}
+            if delimiter:
+                options['delimiter'] = delimiter
+            if marker:
+                options['marker'] = marker
+            response = self.connection.list_bucket(self.bucket, options=options)
+            if response.http_response.status >= 300:
+                raise S3Error(response.message)
+            for common_prefix in response.common_prefixes:
+                yield common_prefix
+            for entry in response.entries:
+                yield entry
+            if not response.is_truncated:
+                break
+            marker = response.next_marker
+            if not marker:
+                if not response.entries:
+                    break
+                marker = response.entries[-1].key
+
+    def warm_cache(self, prefix='', batch_size=1000):
+        """
+        Fills the cache with the size and modified time of every file
+        starting with prefix from a listing of the bucket, saving them in
+        batches. Returns the number of files cached.
+        """
+        if not self.cache:
+            return 0
+        count, batch = 0, {}
+        for entry in self.iter_keys(prefix):
+            batch[entry.key] = (entry.size, parse_iso8601(entry.last_modified))
+            if len(batch) >= batch_size:
+                self.cache.save_many(batch)
+                count += len(batch)
+                batch = {}
+        if batch:
+            self.cache.save_many(batch)
+            count += len(batch)
+        return count
+
+    def walk(self, path=''):
+        """
+        Like ``os.walk``, yields a tuple of ``(dirpath, dirnames, filenames)``
+        for path and every directory below it, top down.
+        """
+        directories, files = self.listdir(path)
+        yield path, directories, files
+        for directory in directories:
+            for result in self.walk(posixpath.join(path, directory)):
+                yield result
+
     def listdir(self, path):
         path = self._path(path)
-        if not path.endswith('/'):
+        if path and not path.endswith('/'):
             path = path+'/'
         directories, files = [], []
-        options = {'prefix': path, 'delimiter': '/'}
-        response = self.connection.list_bucket(self.bucket, options=options)
-        for prefix in response.common_prefixes:
-            directories.append(prefix.prefix.replace(path, '').strip('/'))
-        for entry in response.entries:
-            files.append(entry.key.replace(path, ''))
+        for entry in self.iter_keys(path, delimiter='/'):
+            if isinstance(entry, CommonPrefixEntry):
+                directories.append(entry.prefix[len(path):].strip('/'))
+            else:
+                files.append(entry.key[len(path):])
         return directories, files
 
+    def _async(self, func, *args):
+        """
+        Runs func in the background on a pool of threads shared by this
+        storage. Returns an AsyncResult whose get() waits for and returns
+        the result of func, or raises its exception.
+        """
+        self._async_lock.acquire()
+        try:
+            if self._async_pool is None:
+                self._async_pool = ThreadPool(getattr(
+                    settings, 'CUDDLYBUDDLY_STORAGE_S3_ASYNC_WORKERS', 10))
+        finally:
+            self._async_lock.release()
+        return self._async_pool.apply_async(func, args)
+
+    def aexists(self, name, force_check=False):
+        return self._async(self.exists, name, force_check)
+
+    def asize(self, name, force_check=False):
+        return self._async(self.size, name, force_check)
+
+    def amodified_time(self, name, force_check=False):
+        return self._async(self.modified_time, name, force_check)
+
+    def aopen(self, name, mode='rb'):
+        return self._async(self.open, name, mode)
+
+    def asave(self, name, content):
+        return self._async(self.save, name, content)
+
+    def adelete(self, name):
+        return self._async(self.delete, name)
+
+    def alistdir(self, path):
+        return self._async(self.listdir, path)
+
     def _path(self, name):
         name = name.replace('\\', '/')
         # Because the S3 lib just loves to add slashes
@@ -306,6 +811,43 @@ class S3StorageFile(File):
         self._is_dirty = False
         self.file = StringIO()
         self.start_range = 0
+        self._content = None
+        # Whether the content cache has been tried, which waits for the
+        # first read so that opening a file doesn't make a request.
+        self._content_loaded = False
+        # Where the last read finished, and the open GET sequential reads
+        # after that are served from.
+        self._read_end = None
+        self._stream_response = None
+        self._sequential = True
+        # Recently read blocks of the file for random access, by index.
+        self._blocks = OrderedDict()
+        self._block_size = getattr(settings, 'CUDDLYBUDDLY_STORAGE_S3_READ_BLOCK_SIZE', 64 * 2**10)
+        self._max_blocks = getattr(settings, 'CUDDLYBUDDLY_STORAGE_S3_READ_BLOCKS', 16)
+
+    def _load_content(self):
+        """
+        Serves reads from the storage's content cache if the file is small
+        enough to be kept in it.
+        """
+        self._content_loaded = True
+        content_cache = self._storage.content_cache
+        if content_cache is None or 'w' in self.mode or self._content is not None:
+            return
+        # A size of 0 is also what a missing file gets, which the normal
+        # read reports, and there's nothing worth caching in an empty one.
+        if not 0 < self.size <= content_cache.max_file_size:
+            return
+        self._set_content(self._storage._read_cached(self.name))
+
+    def _set_content(self, content):
+        """
+        Serves reads from content, e.g. from the storage's content cache,
+        instead of S3. Does nothing if content is None.
+        """
+        if content is not None:
+            self._content = content
+            self._size = len(content)
 
     @property
     def size(self):
@@ -318,12 +860,66 @@ class S3StorageFile(File):
         return self.file.getvalue()
 
     def read(self, num_bytes=None):
+        if not self._content_loaded:
+            self._load_content()
+        if self._content is not None:
+            if num_bytes:
+                data = self._content[self.start_range:self.start_range + num_bytes]
+            else:
+                data = self._content[self.start_range:]
+            self.start_range += len(data)
+            self.file = StringIO(data)
+            return data
+
+        if self._stream_response is not None and self._read_end != self.start_range:
+            # There has been a seek, so go back to ranged requests.
+            self._close_stream()
+            self._sequential = False
+
         # Reading past the file size results in a 416 (InvalidRange) error from
         # S3, but accessing the size when not using chunked reading causes an
         # unnecessary HEAD call.
         if self.start_range and self.start_range >= self.size:
             return self._empty_read()
 
+        if self._stream_response is None and num_bytes and self._block_size and \
+           self.start_range >= 0:
+            data = self._read_cached_blocks(num_bytes)
+            if data is not None:
+                self.start_range = self._read_end = self.start_range + len(data)
+                self.file = StringIO(data)
+                return data
+
+        if self._stream_response is None and num_bytes and self._sequential and \
+           self.start_range > 0 and self._read_end == self.start_range:
+            # This read carries on from the last one, so rather than a ranged
+            # request per read, open one GET for the rest of the file and
+            # keep reading from it.
+            try:
+                self._stream_response = self._storage._stream(
+                    self.name, self.start_range, '')[0]
+            except S3Error, e:
+                if '<Code>InvalidRange</Code>' in unicode(e):
+                    return self._empty_read()
+                raise
+
+        if self._stream_response is not None:
+            data = self._stream_response.read(num_bytes)
+            self.start_range = self._read_end = self.start_range + len(data)
+            self.file = StringIO(data)
+            return data
+
+        if num_bytes and self._block_size and self.start_range >= 0:
+            try:
+                data = self._read_blocks(num_bytes)
+            except S3Error, e:
+                if '<Code>InvalidRange</Code>' in unicode(e):
+                    return self._empty_read()
+                raise
+            self.start_range = self._read_end = self.start_range + len(data)
+            self.file = StringIO(data)
+            return data
+
         args = []
 
         if num_bytes:
@@ -347,20 +943,147 @@ class S3StorageFile(File):
             current_range, size = content_range.split(' ', 1)[1].split('/', 1)
             start_range, end_range = current_range.split('-', 1)
             self._size, self.start_range = int(size), int(end_range) + 1
+        self._read_end = self.start_range
 
         self.file = StringIO(data)
         return self.file.getvalue()
 
+    def _block_range(self, num_bytes):
+        """
+        Returns the indexes of the first and last blocks that num_bytes from
+        the current position fall in, stopping at the end of the file if its
+        size is known.
+        """
+        first = self.start_range // self._block_size
+        last = (self.start_range + num_bytes - 1) // self._block_size
+        if hasattr(self, '_size'):
+            last = max(first, min(last, (self._size - 1) // self._block_size))
+        return first, last
+
+    def _read_cached_blocks(self, num_bytes):
+        """
+        Returns num_bytes from the current position if every block they
+        fall in has already been read, otherwise None.
+        """
+        first, last = self._block_range(num_bytes)
+        blocks = []
+        for index in range(first, last + 1):
+            block = self._blocks.get(index)
+            if block is None:
+                # The end of the file doesn't need the following block.
+                if blocks and len(blocks[-1]) < self._block_size:
+                    break
+                return None
+            blocks.append(block)
+            # Move it to the most recently used end.
+            del self._blocks[index]
+            self._blocks[index] = block
+        offset = self.start_range - first * self._block_size
+        return ''.join(blocks)[offset:offset + num_bytes]
+
+    def _read_blocks(self, num_bytes):
+        """
+        Reads whole blocks around the requested bytes with a single ranged
+        request and keeps them so that nearby reads don't need another one.
+        """
+        first, last = self._block_range(num_bytes)
+        missing = [index for index in range(first, last + 1)
+                   if index not in self._blocks]
+        start = missing[0] * self._block_size
+        end = (missing[-1] + 1) * self._block_size - 1
+        data, etag, content_range = self._storage._read(self.name, start, end)
+        if content_range is not None:
+            self._size = int(content_range.split('/', 1)[1])
+        fetched = {}
+        for i in range(0, len(data), self._block_size):
+            fetched[missing[0] + i // self._block_size] = data[i:i + self._block_size]
+        blocks = []
+        for index in range(first, last + 1):
+            block = fetched.get(index, self._blocks.get(index))
+            if block is None:
+                # Past the end of the file.
+                break
+            blocks.append(block)
+            # Every block of this read ends up most recently used, so none of
+            # them can be evicted below.
+            self._blocks.pop(index, None)
+            self._blocks[index] = block
+        while len(self._blocks) > max(self._max_blocks, last - first + 1):
+            self._blocks.popitem(last=False)
+        offset = self.start_range - first * self._block_size
+        return ''.join(blocks)[offset:offset + num_bytes]
+
+    def _close_stream(self):
+        if self._stream_response is not None:
+            self._stream_response.close()
+            self._stream_response = None
+
+    def chunks(self, chunk_size=None):
+        """
+        Reads the whole file from a single GET rather than a ranged request
+        per chunk.
+        """
+        self.seek(0)
+        return self.stream(chunk_size)
+
+    def stream(self, chunk_size=None):
+        """
+        Yields the file from the current position to the end in chunks of
+        ``chunk_size`` bytes from a single GET, so memory use stays constant
+        no matter how large the file is.
+        """
+        if not self._content_loaded:
+            self._load_content()
+        if self._content is not None:
+            chunk_size = chunk_size or self.DEFAULT_CHUNK_SIZE
+            while self.start_range < len(self._content):
+                data = self._content[self.start_range:self.start_range + chunk_size]
+                self.start_range += len(data)
+                yield data
+            return
+        if self.start_range and self.start_range >= self.size:
+            return
+        args = []
+        if self.start_range:
+            args = [self.start_range, '']
+        try:
+            response, etag, content_range = self._storage._stream(self.name, *args)
+        except S3Error, e:
+            if '<Code>InvalidRange</Code>' in unicode(e):
+                return
+            raise
+        if content_range is not None:
+            self._size = int(content_range.split('/', 1)[1])
+        try:
+            for data in response.iter_chunks(chunk_size or self.DEFAULT_CHUNK_SIZE):
+                self.start_range += len(data)
+                yield data
+        finally:
+            response.close()
+
     def write(self, content):
         if 'w' not in self.mode:
             raise AttributeError("File was opened for read-only access.")
-        self.file = StringIO(content)
-        self._is_dirty = True
+        if not self._is_dirty:
+            # Kept in memory until it gets big enough to be worth moving to
+            # disk.
+            self._write_buffer = SpooledTemporaryFile(max_size=getattr(
+                settings,
+                'CUDDLYBUDDLY_STORAGE_S3_WRITE_BUFFER_SIZE',
+                5 * 2**20
+            ))
+            self._is_dirty = True
+        self._write_buffer.write(smart_str(content))
 
     def close(self):
+        self._close_stream()
         if self._is_dirty:
-            self._storage._put_file(self.name, self.file)
-            self._size = len(self.file.getvalue())
+            self._write_buffer.seek(0, 2)
+            self._size = self._write_buffer.tell()
+            self._write_buffer.seek(0)
+            self._storage._put_file(self.name, self._write_buffer)
+            self._write_buffer.close()
+            self._is_dirty = False
         self.file.close()
 
     def seek(self, pos, mode=0):
@@ -373,6 +1096,9 @@ class S3StorageFile(File):
             # While S3 does support negative positions, using them makes tell()
             # unreliable. Getting size is a pretty fast HEAD anyway.
             self.start_range = self.size + pos
+        if self._read_end is not None and self.start_range != self._read_end:
+            # Random access, so don't open a GET for the rest of the file.
+            self._sequential = False
 
     def tell(self):
         return self.start_range
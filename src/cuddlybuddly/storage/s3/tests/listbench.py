@@ -0,0 +1,61 @@
+"""
+Compares how many keys per second each ListParser can get through on a
+generated bucket listing. Run it with::
+
+    python -m cuddlybuddly.storage.s3.tests.listbench [keys] [repeats]
+"""
+
+import sys
+import time
+from cuddlybuddly.storage.s3 import lib
+
+
+def make_listing(keys=1000, truncated=True):
+    parts = [
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+        '<Name>bucket</Name><Prefix>media/</Prefix><Marker></Marker>'
+        '<MaxKeys>%d</MaxKeys><IsTruncated>%s</IsTruncated>'
+        % (keys, truncated and 'true' or 'false')
+    ]
+    for i in xrange(keys):
+        parts.append(
+            '<Contents><Key>media/images/%08d.jpg</Key>'
+            '<LastModified>2009-10-12T17:50:30.000Z</LastModified>'
+            '<ETag>&quot;fba9dede5f27731c9771645a39863328&quot;</ETag>'
+            '<Size>%d</Size><Owner><ID>75aa57f09aa0c8caeab4f8c24e99d10f8e7faeebf76c078efc7c6caea54ba06a</ID>'
+            '<DisplayName>webfile</DisplayName></Owner>'
+            '<StorageClass>STANDARD</StorageClass></Contents>' % (i, i)
+        )
+    parts.append(
+        '<CommonPrefixes><Prefix>media/images/</Prefix></CommonPrefixes>'
+        '</ListBucketResult>'
+    )
+    return ''.join(parts)
+
+
+class FakeResponse(object):
+    status = 200
+    reason = 'OK'
+
+    def __init__(self, body):
+        self.body = body
+
+    def read(self):
+        return self.body
+
+
+def benchmark(parser, body, keys, repeats):
+    start = time.time()
+    for i in xrange(repeats):
+        lib.ListBucketResponse(FakeResponse(body), parser)
+    return keys * repeats / (time.time() - start)
+
+
+if __name__ == '__main__':
+    keys = len(sys.argv) > 1 and int(sys.argv[1]) or 1000
+    repeats = len(sys.argv) > 2 and int(sys.argv[2]) or 50
+    body = make_listing(keys)
+    for name in ('SAX', 'ETREE'):
+        print '%-6s %12.0f keys/sec' % (
+            name, benchmark(getattr(lib.ListParser, name), body, keys, repeats))
@@ -1,6 +1,8 @@
 from datetime import datetime, timedelta
 import httplib
+import json
 import os
+import socket
 from StringIO import StringIO
 from time import sleep
 import urlparse
@@ -15,8 +17,11 @@ from django.test.utils import override_settings
 from django.utils.encoding import force_unicode
 from django.utils.http import urlquote
 from cuddlybuddly.storage.s3 import lib
+from cuddlybuddly.storage.s3.cache import DjangoCache, FileSystemCache, \
+    FileSystemContentCache, MemoryCache, SQLiteCache
 from cuddlybuddly.storage.s3.exceptions import S3Error
-from cuddlybuddly.storage.s3.storage import S3Storage
+from cuddlybuddly.storage.s3.storage import S3Storage, S3StorageFile
+from cuddlybuddly.storage.s3.tests.listbench import FakeResponse, make_listing
 from cuddlybuddly.storage.s3.utils import CloudFrontURLs, create_signed_url
 
 
@@ -41,6 +46,28 @@ class UnicodeContentFile(ContentFile):
         self.size = len(content)
 
 
+class FakeReadStorage(object):
+    """
+    Serves S3StorageFile's ranged reads from a string, recording each one.
+    """
+
+    content_cache = None
+
+    def __init__(self, content):
+        self.content = content
+        self.reads = []
+
+    def size(self, name):
+        return len(self.content)
+
+    def _read(self, name, start_range=None, end_range=None):
+        self.reads.append((start_range, end_range))
+        data = self.content[start_range:end_range + 1]
+        content_range = 'bytes %d-%d/%d' % (
+            start_range, start_range + len(data) - 1, len(self.content))
+        return data, None, content_range
+
+
 class S3StorageTests(TestCase):
     def run_test(self, filename, content='Lorem ipsum dolar sit amet'):
         content = UnicodeContentFile(content)
@@ -132,6 +159,13 @@ class S3StorageTests(TestCase):
         file.close()
         self.assertEqual(file.size, 11)
 
+        file = default_storage.open(filename, 'w')
+        file.write('Lorem ipsum')
+        file.write(' dolor')
+        file.close()
+        self.assertEqual(file.size, 17)
+        self.assertEqual(default_storage.open(filename).read(), 'Lorem ipsum dolor')
+
         default_storage.delete(filename)
         self.assert_(not default_storage.exists(filename))
 
@@ -151,6 +185,22 @@ class S3StorageTests(TestCase):
         self.assertEqual(dirs, [])
         self.assertEqual(files, ['file5.txt'])
 
+        for file in content:
+            default_storage.cache.remove(file)
+        self.assertEqual(default_storage.warm_cache(folder), len(content))
+        for file in content:
+            self.assertEqual(default_storage.cache.size(file), 26)
+
+        self.assertEqual(
+            sorted(entry.key for entry in default_storage.iter_keys(folder)),
+            sorted(content)
+        )
+        self.assertEqual(
+            list(default_storage.walk(folder)),
+            [(folder, ['sub'], ['file3.txt', 'file4.txt']),
+             (folder+'sub', [], ['file5.txt'])]
+        )
+
         for file in content:
             default_storage.delete(file)
             self.assert_(not default_storage.exists(file))
@@ -187,6 +237,15 @@ class S3StorageTests(TestCase):
         if ct_backup is not None:
             settings.CUDDLYBUDDLY_STORAGE_S3_GZIP_CONTENT_TYPES = ct_backup
 
+    @override_settings(CUDDLYBUDDLY_STORAGE_S3_GZIP_CONTENT_TYPES=('text/css',))
+    def test_gzip_incompressible(self):
+        filename = 'testsdir/filegzipincompressible.css'
+        content = os.urandom(4096)
+        default_storage.save(filename, UnicodeContentFile(content))
+        self.assertEqual(default_storage.size(filename, force_check=True), 4096)
+        self.assertEqual(default_storage.open(filename).read(), content)
+        default_storage.delete(filename)
+
     def test_exists_on_empty_path(self):
         self.assert_(not default_storage.exists(''))
         self.assert_(not default_storage.exists(None))
@@ -230,6 +289,202 @@ class S3StorageTests(TestCase):
 
         default_storage.delete(filename)
 
+    @override_settings(
+        CUDDLYBUDDLY_STORAGE_S3_GZIP_CONTENT_TYPES=(),
+        CUDDLYBUDDLY_STORAGE_S3_MULTIPART_THRESHOLD=1024,
+        CUDDLYBUDDLY_STORAGE_S3_MULTIPART_CHUNK_SIZE=5 * 2**20
+    )
+    def test_multipart_upload(self):
+        filename = 'testsdir/filemultipart.txt'
+        content = 'Lorem ipsum ' * (2**19)
+        filename = default_storage.save(filename, UnicodeContentFile(content))
+        self.assertEqual(default_storage.size(filename, force_check=True), len(content))
+        file_ = default_storage.open(filename)
+        self.assertEqual(file_.read(), content)
+        file_.close()
+        default_storage.delete(filename)
+
+    def test_overwrite(self):
+        filename = default_storage.save('testsdir/fileoverwrite.txt',
+                                        UnicodeContentFile('Lorem ipsum'))
+        self.assertEqual(
+            default_storage.overwrite(filename, UnicodeContentFile('Dolor sit amet'),
+                                      {'md5': 'abc'}),
+            filename
+        )
+        self.assertEqual(default_storage.open(filename).read(), 'Dolor sit amet')
+        self.assertEqual(default_storage.size(filename), 14)
+        response = default_storage.connection._make_request(
+            'HEAD', default_storage.bucket, filename)
+        self.assertEqual(response.getheader('x-amz-meta-md5'), 'abc')
+        default_storage.delete(filename)
+
+    def test_delete_many(self):
+        filenames = [
+            default_storage.save('testsdir/filedeletemany%s.txt' % i,
+                                 UnicodeContentFile('Lorem ipsum dolor sit amet'))
+            for i in range(3)
+        ]
+        filenames.append(default_storage.save(u'testsdir/\u00e8deletemany.txt',
+                                              UnicodeContentFile('Lorem ipsum')))
+        for filename in filenames:
+            self.assert_(default_storage.exists(filename))
+        self.assertEqual(default_storage.delete_many(filenames), {})
+        for filename in filenames:
+            self.assert_(not default_storage.exists(filename))
+
+    def test_copy_and_move(self):
+        filename = default_storage.save('testsdir/filecopy.txt',
+                                        UnicodeContentFile('Lorem ipsum dolor sit amet'))
+        copied = default_storage.copy(filename, 'testsdir/filecopied.txt')
+        self.assertEqual(copied, 'testsdir/filecopied.txt')
+        self.assertEqual(default_storage.open(copied).read(), 'Lorem ipsum dolor sit amet')
+        moved = default_storage.move(copied, u'testsdir/\u00e8filemoved.txt')
+        self.assert_(not default_storage.exists(copied))
+        self.assertEqual(default_storage.open(moved).read(), 'Lorem ipsum dolor sit amet')
+        self.assertEqual(default_storage.size(moved, force_check=True), 26)
+        default_storage.delete(filename)
+        default_storage.delete(moved)
+
+    @override_settings(CUDDLYBUDDLY_STORAGE_S3_MULTIPART_COPY_THRESHOLD=1,
+                       CUDDLYBUDDLY_STORAGE_S3_MULTIPART_COPY_CHUNK_SIZE=1)
+    def test_multipart_copy(self):
+        content = 'Lorem ipsum ' * (2**19)
+        filename = default_storage.save('testsdir/filemultipartcopy.txt',
+                                        UnicodeContentFile(content))
+        copied = default_storage.copy(filename, 'testsdir/filemultipartcopied.txt')
+        self.assertEqual(default_storage.size(copied, force_check=True), len(content))
+        file_ = default_storage.open(copied)
+        self.assertEqual(file_.read(), content)
+        file_.close()
+        default_storage.delete_many([filename, copied])
+
+    def test_async(self):
+        filename = 'testsdir/fileasync.txt'
+        self.assert_(not default_storage.aexists(filename).get())
+        filename = default_storage.asave(filename, UnicodeContentFile('Lorem ipsum')).get()
+        self.assertEqual(default_storage.asize(filename).get(), 11)
+        self.assertEqual(default_storage.aopen(filename).get().read(), 'Lorem ipsum')
+        self.assert_('fileasync.txt' in default_storage.alistdir('testsdir').get()[1])
+        default_storage.adelete(filename).get()
+        self.assert_(not default_storage.exists(filename))
+
+    def run_stat_many_test(self):
+        filenames = [
+            default_storage.save('testsdir/filestat%s.txt' % i,
+                                 UnicodeContentFile('Lorem ipsum ' * (i + 1)))
+            for i in range(3)
+        ]
+        names = filenames + ['testsdir/filestatmissing.txt']
+        stats = default_storage.stat_many(names, force_check=True)
+        self.assertEqual(sorted(stats.keys()), sorted(names))
+        self.assertEqual(stats['testsdir/filestatmissing.txt'], None)
+        for i, filename in enumerate(filenames):
+            self.assertEqual(stats[filename][0], 12 * (i + 1))
+            self.assertEqual(stats[filename][1], default_storage.modified_time(filename))
+        self.assertEqual(default_storage.stat_many(names), stats)
+        default_storage.delete_many(filenames)
+
+    def test_stat_many(self):
+        self.run_stat_many_test()
+
+    @override_settings(CUDDLYBUDDLY_STORAGE_S3_STAT_LIST_THRESHOLD=1)
+    def test_stat_many_from_listing(self):
+        self.run_stat_many_test()
+
+    def test_content_cache(self):
+        content_cache = FileSystemContentCache(
+            os.path.join(settings.TEMP, 'cbs3testcontentcache'))
+        storage = S3Storage(content_cache=content_cache)
+        filename = storage.save('testsdir/filecontentcache.txt',
+                                UnicodeContentFile('Lorem ipsum dolor sit amet'))
+        self.assertEqual(storage.open(filename).read(), 'Lorem ipsum dolor sit amet')
+        self.assertEqual(content_cache.get(filename)[1], 'Lorem ipsum dolor sit amet')
+        file_ = storage.open(filename)
+        self.assertEqual(file_.read(5), 'Lorem')
+        self.assertEqual(file_.read(), ' ipsum dolor sit amet')
+        storage.delete(filename)
+        self.assertEqual(content_cache.get(filename), None)
+
+    @override_settings(
+        CUDDLYBUDDLY_STORAGE_S3_GZIP_CONTENT_TYPES=(),
+        CUDDLYBUDDLY_STORAGE_S3_READ_BLOCK_SIZE=0
+    )
+    def test_sequential_read(self):
+        filename = default_storage.save('testsdir/filesequential.txt',
+                                        UnicodeContentFile('Lorem ipsum ' * 200))
+        file_ = default_storage.open(filename)
+        data = [file_.read(1000) for i in range(3)]
+        self.assertEqual(map(len, data), [1000, 1000, 400])
+        self.assert_(file_._stream_response is not None)
+        file_.seek(12)
+        self.assertEqual(file_.read(11), 'Lorem ipsum')
+        self.assertEqual(file_._stream_response, None)
+        file_.close()
+        self.assertEqual(''.join(data), 'Lorem ipsum ' * 200)
+        default_storage.delete(filename)
+
+    @override_settings(
+        CUDDLYBUDDLY_STORAGE_S3_GZIP_CONTENT_TYPES=(),
+        CUDDLYBUDDLY_STORAGE_S3_READ_BLOCK_SIZE=1000,
+        CUDDLYBUDDLY_STORAGE_S3_READ_BLOCKS=2
+    )
+    def test_block_read(self):
+        content = ''.join(chr(ord('a') + i % 26) for i in range(2400))
+        filename = default_storage.save('testsdir/fileblocks.txt',
+                                        UnicodeContentFile(content))
+        file_ = default_storage.open(filename)
+        file_.seek(-100, 2)
+        self.assertEqual(file_.read(50), content[-100:-50])
+        self.assertEqual(file_._blocks.keys(), [2])
+        file_.seek(1990)
+        self.assertEqual(file_.read(20), content[1990:2010])
+        self.assertEqual(file_._blocks.keys(), [1, 2])
+        file_.seek(2300)
+        self.assertEqual(file_.read(), content[2300:])
+        file_.seek(10)
+        self.assertEqual(file_.read(10), content[10:20])
+        self.assertEqual(file_._blocks.keys(), [2, 0])
+        file_.close()
+        default_storage.delete(filename)
+
+    @override_settings(CUDDLYBUDDLY_STORAGE_S3_READ_BLOCK_SIZE=1000,
+                       CUDDLYBUDDLY_STORAGE_S3_READ_BLOCKS=3)
+    def test_block_read_eviction(self):
+        content = ''.join(chr(ord('a') + i % 26) for i in range(5000))
+        storage = FakeReadStorage(content)
+        file_ = S3StorageFile('fileblocks.txt', storage, 'rb')
+        for index in (2, 4, 0):
+            file_._blocks[index] = content[index * 1000:(index + 1) * 1000]
+        file_.seek(500)
+        # Cached, missing and then cached again, with block 2 the oldest.
+        self.assertEqual(file_.read(2000), content[500:2500])
+        self.assertEqual(storage.reads, [(1000, 1999)])
+        self.assertEqual(file_._blocks.keys(), [0, 1, 2])
+
+    @override_settings(CUDDLYBUDDLY_STORAGE_S3_READ_BLOCK_SIZE=1000)
+    def test_block_read_past_end(self):
+        content = ''.join(chr(ord('a') + i % 26) for i in range(3000))
+        storage = FakeReadStorage(content)
+        file_ = S3StorageFile('fileblocksend.txt', storage, 'rb')
+        file_.seek(-22, 2)
+        self.assertEqual(file_.read(22), content[-22:])
+        # The last block is full, but there's nothing after it to read.
+        file_.seek(-100, 2)
+        self.assertEqual(file_.read(1000), content[-100:])
+        self.assertEqual(storage.reads, [(2000, 2999)])
+
+    def test_content_cache_skips_large_files(self):
+        content = 'Lorem ipsum ' * 100
+        storage = FakeReadStorage(content)
+        storage.content_cache = FileSystemContentCache(
+            os.path.join(settings.TEMP, 'cbs3testcontentcache'), max_file_size=100)
+        storage._read_cached = lambda name: self.fail('Too big to cache')
+        file_ = S3StorageFile('filelarge.txt', storage, 'rb')
+        self.assertEqual(storage.reads, [])
+        self.assertEqual(file_.read(5), 'Lorem')
+        self.assertEqual(file_._content, None)
+
     def test_chunked_zipfile_read(self):
         """
         A zip file's central directory is located at the end of the file and
@@ -360,6 +615,456 @@ B0IGbQoTRFdE4VVcPK0CQQCeS84lODlC0Y2BZv2JxW3Osv/WkUQ4dslfAQl1T303
         )
 
 
+class FileSystemCacheTests(TestCase):
+    def test_cache(self):
+        cache = FileSystemCache()
+        name = u'testsdir/\u00E1.txt'
+        cache.remove(name)
+        self.assertEqual(cache.exists(name), None)
+        cache.save(name, 1, 10.5)
+        self.assertEqual(cache.exists(name), True)
+        self.assertEqual(cache.size(name), 1)
+        self.assertEqual(cache.modified_time(name), 10.5)
+        cache.save(name, 2, 20)
+        self.assertEqual(cache.size(name), 2)
+        cache.save_missing(name)
+        self.assertEqual(cache.exists(name), False)
+        self.assertEqual(cache.size(name), None)
+        cache.remove(name)
+        self.assertEqual(cache.exists(name), None)
+
+
+class FileSystemContentCacheTests(TestCase):
+    def setUp(self):
+        self.cache_dir = os.path.join(settings.TEMP, 'cbs3testcontentcache')
+        self.cache = FileSystemContentCache(self.cache_dir, max_size=100)
+
+    def tearDown(self):
+        for name in ('a', 'b', 'c'):
+            self.cache.remove(name)
+
+    def test_evict(self):
+        for i, name in enumerate(('a', 'b', 'c')):
+            self.cache.save(name, 'etag', name * 39)
+            # Make the order certain on filesystems with coarse times.
+            os.utime(self.cache._path(name), (i, i))
+        self.assertEqual(self.cache.get('a'), None)
+        self.assertEqual(self.cache.get('b'), ('etag', 'b' * 39))
+        self.assertEqual(self.cache.get('c'), ('etag', 'c' * 39))
+        self.assertEqual(self.cache._total, 88)
+        self.cache.remove('b')
+        self.assertEqual(self.cache._total, 44)
+
+
+class MemoryCacheTests(TestCase):
+    def test_lru(self):
+        cache = MemoryCache(max_entries=2, timeout=None, backend=None)
+        self.assertEqual(cache.exists('a'), None)
+        cache.save('a', 1, 10)
+        cache.save('b', 2, 20)
+        self.assertEqual(cache.size('a'), 1)
+        cache.save('c', 3, 30)
+        self.assertEqual(cache.size('b'), None)
+        self.assertEqual(cache.modified_time('a'), 10)
+        self.assertEqual(cache.modified_time('c'), 30)
+        cache.remove('a')
+        self.assertEqual(cache.exists('a'), None)
+
+    def test_missing(self):
+        cache = MemoryCache(backend=None)
+        cache.save_missing('a')
+        self.assertEqual(cache.exists('a'), False)
+        self.assertEqual(cache.size('a'), None)
+        cache.save('a', 1, 10)
+        self.assertEqual(cache.exists('a'), True)
+        with self.settings(CUDDLYBUDDLY_STORAGE_S3_MISSING_TIMEOUT=-1):
+            cache.save_missing('b')
+        self.assertEqual(cache.exists('b'), None)
+
+    def test_timeout(self):
+        cache = MemoryCache(timeout=-1, backend=None)
+        cache.save('a', 1, 10)
+        self.assertEqual(cache.size('a'), None)
+
+    def test_backend(self):
+        backend = MemoryCache(backend=None)
+        cache = MemoryCache(backend=backend)
+        backend.save('a', 1, 10)
+        self.assertEqual(cache.size('a'), 1)
+        backend.remove('a')
+        self.assertEqual(cache.size('a'), 1)
+        cache.save('b', 2, 20)
+        self.assertEqual(backend.modified_time('b'), 20)
+
+    @override_settings(
+        CUDDLYBUDDLY_STORAGE_S3_MEMORY_CACHE_TIMEOUT=-1,
+        CUDDLYBUDDLY_STORAGE_S3_MEMORY_CACHE_BACKEND='cuddlybuddly.storage.s3.cache.FileSystemCache',
+        CUDDLYBUDDLY_STORAGE_S3_FILE_CACHE_DIR=os.path.join(settings.TEMP, 'cbs3testcache')
+    )
+    def test_settings(self):
+        cache = MemoryCache()
+        self.assertEqual(cache.timeout, -1)
+        self.assert_(isinstance(cache.backend, FileSystemCache))
+        cache = MemoryCache(timeout=None, backend=None)
+        self.assertEqual((cache.timeout, cache.backend), (None, None))
+
+
+class DjangoCacheTests(TestCase):
+    def test_cache(self):
+        cache = DjangoCache()
+        self.assertEqual(cache.exists('testsdir/a.txt'), None)
+        cache.save('testsdir/a.txt', 1, 10)
+        self.assertEqual(cache.exists('testsdir/a.txt'), True)
+        self.assertEqual(cache.size('testsdir/a.txt'), 1)
+        self.assertEqual(cache.modified_time('testsdir/a.txt'), 10)
+        cache.save_many({u'testsdir/\u00E1.txt': (2, 20)})
+        self.assertEqual(
+            cache.get_many(['testsdir/a.txt', u'testsdir/\u00E1.txt', 'testsdir/c.txt']),
+            {'testsdir/a.txt': (1, 10), u'testsdir/\u00E1.txt': (2, 20)}
+        )
+        cache.remove('testsdir/a.txt')
+        cache.remove(u'testsdir/\u00E1.txt')
+        self.assertEqual(cache.size('testsdir/a.txt'), None)
+
+
+class SQLiteCacheTests(TestCase):
+    def setUp(self):
+        self.path = os.path.join(settings.TEMP, 'cbs3testcache.sqlite')
+        self.cache = SQLiteCache(self.path)
+
+    def tearDown(self):
+        self.cache.db.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    def test_cache(self):
+        cache = self.cache
+        cache.save_many(dict(('a/%s' % i, (i, i * 10.0)) for i in range(600)))
+        cache.save(u'b/\u00E1.txt', 1, 10.0)
+        self.assertEqual(cache.exists('a/1'), True)
+        self.assertEqual(cache.exists('c'), None)
+        self.assertEqual(cache.size('a/2'), 2)
+        self.assertEqual(cache.modified_time('a/3'), 30.0)
+        self.assertEqual(len(cache.get_many(['a/%s' % i for i in range(700)])), 600)
+        self.assertEqual(list(cache.iter_prefix('b/')), [(u'b/\u00E1.txt', 1, 10.0)])
+        cache.remove_many(['a/%s' % i for i in range(500)])
+        self.assertEqual(len(list(cache.iter_prefix('a/'))), 100)
+        cache.remove(u'b/\u00E1.txt')
+        self.assertEqual(cache.size(u'b/\u00E1.txt'), None)
+
+
+class FakeHeadResponse(FakeResponse):
+    reason = 'Not Found'
+
+    def __init__(self, status, headers={}):
+        FakeResponse.__init__(self, '')
+        self.status = status
+        self.headers = self.msg = headers
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+
+class UploadTests(TestCase):
+    def setUp(self):
+        self.storage = S3Storage(cache=MemoryCache(max_entries=100, timeout=60, backend=None))
+        self.storage._put_multipart = self.put_multipart
+
+    def put_multipart(self, name, content, headers, metadata=None):
+        content.read(100)
+        raise S3Error('Part 1 failed')
+
+    @override_settings(CUDDLYBUDDLY_STORAGE_S3_MULTIPART_THRESHOLD=1024)
+    def test_failed_multipart_upload(self):
+        content = ContentFile('Lorem ipsum ' * 100)
+        content.seek(10)
+        self.assertRaises(S3Error, self.storage._put_file, 'testsdir/failed.txt',
+                          content)
+        self.assertEqual(self.storage.cache.exists('testsdir/failed.txt'), None)
+        self.assertEqual(content.tell(), 10)
+
+
+class MissingFileTests(TestCase):
+    def setUp(self):
+        self.storage = S3Storage(
+            cache=MemoryCache(max_entries=100, timeout=60, backend=None),
+            content_cache=FileSystemContentCache(
+                os.path.join(settings.TEMP, 'cbs3testcontentcache')))
+        self.storage.connection._make_request = self.make_request
+
+    def make_request(self, method, bucket, key, query_args={}, headers={}):
+        return FakeHeadResponse(404)
+
+    def test_read(self):
+        file_ = self.storage.open('testsdir/missing.txt')
+        self.assertRaises(S3Error, file_.read)
+        self.assertEqual(self.storage.cache.exists('testsdir/missing.txt'), None)
+
+
+class CopyTests(TestCase):
+    def setUp(self):
+        self.storage = S3Storage(cache=MemoryCache(max_entries=100, timeout=60, backend=None))
+        self.heads, self.copies = {}, []
+        self.storage.connection._make_request = self.make_request
+        self.storage.connection.copy = self.copy
+
+    def make_request(self, method, bucket, key):
+        return self.heads.get(key, FakeHeadResponse(404))
+
+    def copy(self, source_bucket, source_key, bucket, key, headers):
+        self.copies.append((source_key, key))
+        return lib.CopyObjectResponse(FakeResponse(
+            '<CopyObjectResult><LastModified>2011-03-07T12:00:00.000Z</LastModified>'
+            '<ETag>"abc"</ETag></CopyObjectResult>'
+        ))
+
+    def test_copy(self):
+        # A stale size in the cache isn't used.
+        self.storage.cache.save('testsdir/src.txt', 5, 1)
+        self.heads['testsdir/src.txt'] = FakeHeadResponse(200, {'content-length': '26'})
+        self.assertEqual(self.storage.copy('testsdir/src.txt', 'testsdir/dst.txt'),
+                         'testsdir/dst.txt')
+        self.assertEqual(self.copies, [('testsdir/src.txt', 'testsdir/dst.txt')])
+        self.assertEqual(self.storage.cache.size('testsdir/dst.txt'), 26)
+        self.assertEqual(self.storage.cache.modified_time('testsdir/dst.txt'), 1299499200)
+
+    def test_copy_missing(self):
+        # The placeholder saved while uploading.
+        self.storage.cache.save('testsdir/src.txt', 0, 0)
+        self.assertRaises(S3Error, self.storage.copy, 'testsdir/src.txt',
+                          'testsdir/dst.txt')
+        self.assertEqual(self.copies, [])
+
+
+class StatManyTests(TestCase):
+    def setUp(self):
+        self.storage = S3Storage(cache=MemoryCache(max_entries=10000, timeout=60, backend=None))
+        self.keys = ['gallery/%04d.jpg' % i for i in range(3000)]
+        self.listings, self.heads = [], []
+        self.storage.iter_keys = self.iter_keys
+        self.storage._stat = self.stat
+
+    def iter_keys(self, prefix='', delimiter=None, marker=''):
+        self.listings.append((prefix, marker))
+        for key in self.keys:
+            if key.startswith(prefix) and key > marker:
+                yield lib.ListEntry(key, '2011-03-07T12:00:00.000Z', size='26')
+
+    def stat(self, name):
+        self.heads.append(name)
+        if name in self.keys:
+            return 26, 1299499200
+        return None
+
+    @override_settings(CUDDLYBUDDLY_STORAGE_S3_STAT_LIST_THRESHOLD=2,
+                       CUDDLYBUDDLY_STORAGE_S3_STAT_LIST_PAGES=1)
+    def test_listing(self):
+        names = ['gallery/0500.jpg', 'gallery/0501.jpg', 'gallery/0502.txt',
+                 'gallery/2500.jpg']
+        stats = self.storage.stat_many(names)
+        self.assertEqual(self.listings, [('gallery/', 'gallery/0500.jp')])
+        # The listing stopped a page after the first name.
+        self.assertEqual(self.heads, ['gallery/2500.jpg'])
+        self.assertEqual(stats['gallery/0502.txt'], None)
+        for name in ('gallery/0500.jpg', 'gallery/0501.jpg', 'gallery/2500.jpg'):
+            self.assertEqual(stats[name], (26, datetime.fromtimestamp(1299499200)))
+
+        self.listings, self.heads = [], []
+        self.assertEqual(self.storage.stat_many(names), stats)
+        self.assertEqual((self.listings, self.heads), ([], []))
+
+    def test_concurrent(self):
+        names = ['gallery/0001.jpg', 'other/0001.jpg']
+        stats = self.storage.stat_many(names)
+        self.assertEqual(sorted(self.heads), names)
+        self.assertEqual(stats['other/0001.jpg'], None)
+        self.assertEqual(stats['gallery/0001.jpg'][0], 26)
+        self.heads = []
+        self.storage.stat_many(names)
+        self.assertEqual(self.heads, [])
+
+
+class ListParserTests(TestCase):
+    def test_parsers_match(self):
+        body = make_listing(50)
+        sax = lib.ListBucketResponse(FakeResponse(body), lib.ListParser.SAX)
+        etree = lib.ListBucketResponse(FakeResponse(body), lib.ListParser.ETREE)
+        for attr in ('name', 'prefix', 'marker', 'is_truncated', 'delimiter',
+                     'max_keys', 'next_marker'):
+            self.assertEqual(getattr(sax, attr), getattr(etree, attr))
+        entry = lambda e: (e.key, e.last_modified, e.etag, e.size,
+                           e.storage_class, e.owner.id, e.owner.display_name)
+        self.assertEqual(map(entry, sax.entries), map(entry, etree.entries))
+        self.assertEqual(
+            [p.prefix for p in sax.common_prefixes],
+            [p.prefix for p in etree.common_prefixes]
+        )
+
+
+class FakePoolResponse(FakeResponse):
+    will_close = False
+
+    def __init__(self, body=''):
+        FakeResponse.__init__(self, body)
+        self.closed = False
+
+    def read(self):
+        self.closed = True
+        return self.body
+
+    def isclosed(self):
+        return self.closed
+
+
+class FakeConnection(object):
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.closed = False
+        self.requests = []
+
+    def request(self, method, path, data, headers):
+        if self.fail:
+            raise socket.error('Connection reset by peer')
+        self.requests.append((method, path))
+
+    def getresponse(self):
+        return FakePoolResponse()
+
+    def close(self):
+        self.closed = True
+
+
+class FakeConnectionPool(lib.ConnectionPool):
+    def connect(self, is_secure, host):
+        return FakeConnection()
+
+
+class ConnectionPoolTests(TestCase):
+    def test_reuse(self):
+        pool = FakeConnectionPool()
+        connection, reused = pool.get(True, 'host')
+        self.assert_(not reused)
+        response = FakePoolResponse()
+        pool.put(True, 'host', connection, response)
+        # Not until the response has been read.
+        other, reused = pool.get(True, 'host')
+        self.assert_(other is not connection and not reused)
+        response.read()
+        self.assertEqual(pool.get(True, 'host'), (connection, True))
+        # Only for the same host.
+        pool.put(True, 'host', connection)
+        self.assert_(pool.get(False, 'host')[0] is not connection)
+        self.assert_(pool.get(True, 'other')[0] is not connection)
+
+    def test_will_close(self):
+        pool = FakeConnectionPool()
+        connection = FakeConnection()
+        response = FakePoolResponse()
+        response.will_close = True
+        pool.put(True, 'host', connection, response)
+        self.assert_(pool.get(True, 'host')[0] is not connection)
+
+    def test_idle_timeout(self):
+        pool = FakeConnectionPool(idle_timeout=-1)
+        connection = FakeConnection()
+        pool.put(True, 'host', connection)
+        self.assert_(pool.get(True, 'host')[0] is not connection)
+        self.assert_(connection.closed)
+
+    def test_abandoned_response(self):
+        pool = FakeConnectionPool(max_size=2, idle_timeout=-1)
+        abandoned = [FakeConnection(), FakeConnection()]
+        for connection in abandoned:
+            pool.put(True, 'host', connection, FakePoolResponse())
+        # Unread responses don't keep their place past the idle timeout.
+        connection = FakeConnection()
+        pool.put(True, 'host', connection)
+        pool.idle_timeout = 60
+        self.assertEqual(pool.get(True, 'host'), (connection, True))
+        self.assert_(not [c for c in abandoned if c.closed])
+
+    def test_max_size(self):
+        pool = FakeConnectionPool(max_size=1)
+        connections = [FakeConnection(), FakeConnection()]
+        for connection in connections:
+            pool.put(True, 'host', connection)
+        self.assertEqual(pool.get(True, 'host'), (connections[0], True))
+        self.assertEqual(pool.get(True, 'host')[1], False)
+
+    def test_stale_connection(self):
+        pool = FakeConnectionPool()
+        conn = lib.AWSAuthConnection('key', 'secret', pool=pool)
+        stale = FakeConnection(fail=True)
+        pool.put(True, 'host', stale)
+        response = conn._send(True, 'host', 'GET', '/key', '', {})
+        self.assert_(stale.closed)
+        # The response came from a new connection, which went back in the
+        # pool.
+        response.read()
+        connection, reused = pool.get(True, 'host')
+        self.assert_(reused)
+        self.assertEqual(connection.requests, [('GET', '/key')])
+
+    def test_new_connection_failure(self):
+        pool = FakeConnectionPool()
+        pool.connect = lambda is_secure, host: FakeConnection(fail=True)
+        conn = lib.AWSAuthConnection('key', 'secret', pool=pool)
+        # Only reused connections are tried again.
+        self.assertRaises(socket.error, conn._send, True, 'host', 'GET', '/key', '', {})
+
+
+class RetryPolicyTests(TestCase):
+    def make_connection(self, results, policy):
+        conn = lib.AWSAuthConnection('key', 'secret', retry_policy=policy)
+        sent = []
+        def send(is_secure, host, method, path, data, headers):
+            sent.append(hasattr(data, 'read') and data.read() or data)
+            result = results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            response = FakeResponse('')
+            response.status = result
+            return response
+        conn._send = send
+        return conn, sent
+
+    def test_retry(self):
+        policy = lib.RetryPolicy(max_attempts=3, backoff=0)
+        conn, sent = self.make_connection([503, socket.error(), 200], policy)
+        self.assertEqual(conn._make_request('PUT', 'bucket', 'key', data=StringIO('abc')).status, 200)
+        self.assertEqual(sent, ['abc', 'abc', 'abc'])
+        self.assertEqual((policy.retries, policy.failures), (2, 0))
+
+        conn, sent = self.make_connection([500, 500, 500], policy)
+        self.assertEqual(conn._make_request('GET', 'bucket', 'key').status, 500)
+        self.assertEqual((policy.retries, policy.failures), (4, 1))
+
+    def test_retry_delete_multiple(self):
+        policy = lib.RetryPolicy(max_attempts=3, backoff=0)
+        conn, sent = self.make_connection([503, 200], policy)
+        self.assertEqual(conn._make_request('POST', 'bucket', '', {'delete': None},
+                                            data='<Delete/>').status, 200)
+        self.assertEqual(sent, ['<Delete/>', '<Delete/>'])
+        self.assertEqual((policy.retries, policy.failures), (1, 0))
+
+    def test_no_retry(self):
+        policy = lib.RetryPolicy(max_attempts=3, backoff=0)
+        conn, sent = self.make_connection([503], policy)
+        self.assertEqual(conn._make_request('POST', 'bucket', 'key').status, 503)
+        conn, sent = self.make_connection([503], policy)
+        self.assertEqual(conn._make_request('POST', 'bucket', 'key', {'uploads': None}).status, 503)
+        conn, sent = self.make_connection([socket.error()], policy)
+        self.assertRaises(socket.error, conn._make_request, 'PUT', 'bucket',
+                          'key', data=iter(['abc']))
+        self.assertEqual((policy.retries, policy.failures), (0, 0))
+
+    def test_delay(self):
+        policy = lib.RetryPolicy(backoff=1, max_backoff=5)
+        for attempt in range(1, 10):
+            self.assert_(0 <= policy.delay(attempt) <= min(5, 2**(attempt - 1)))
+
+
 class TemplateTagsTests(TestCase):
     def render_template(self, source, context=None):
         if not context:
@@ -491,6 +1196,20 @@ class CommandTests(TestCase):
                 'If this is failing, try resyncing your computer\'s clock.'
             )
 
+        call_command(
+            'cb_s3_sync_media',
+            verbosity=0,
+            dir=self.basepath,
+            prefix=self.folder,
+            list=True
+        )
+        for file in self.files.keys():
+            self.assertEqual(
+                modified_times[file],
+                default_storage.modified_time(os.path.join(self.folder, file)),
+                'If this is failing, try resyncing your computer\'s clock.'
+            )
+
         call_command(
             'cb_s3_sync_media',
             verbosity=0,
@@ -507,6 +1226,73 @@ class CommandTests(TestCase):
         for file in self.files.keys():
             default_storage.delete(os.path.join(self.folder, file))
 
+    def sync(self, **options):
+        call_command(
+            'cb_s3_sync_media',
+            verbosity=0,
+            dir=self.basepath,
+            prefix=self.folder,
+            **options
+        )
+
+    def get_modified_times(self):
+        return dict(
+            (file, default_storage.modified_time(
+                os.path.join(self.folder, file), force_check=True))
+            for file in self.files.keys()
+        )
+
+    def test_sync_hash(self):
+        # Gzipped, so its etag is never the MD5 of the file.
+        self.files['test5.css'] = 'body { color: red; }\n' * 100
+        fh = open(os.path.join(self.basepath, 'test5.css'), 'w')
+        fh.write(self.files['test5.css'])
+        fh.close()
+        self.sync(hash=True)
+        modified_times = self.get_modified_times()
+        sleep(1)
+        # Newer modified times alone don't cause an upload.
+        for file in self.files.keys():
+            os.utime(os.path.join(self.basepath, file), None)
+        self.sync(hash=True)
+        self.assertEqual(self.get_modified_times(), modified_times)
+        fh = open(os.path.join(self.basepath, 'test1.txt'), 'w')
+        fh.write('Changed')
+        fh.close()
+        self.sync(hash=True)
+        new_modified_times = self.get_modified_times()
+        self.assert_(new_modified_times.pop('test1.txt') > modified_times.pop('test1.txt'))
+        self.assertEqual(new_modified_times, modified_times)
+        for file in self.files.keys():
+            default_storage.delete(os.path.join(self.folder, file))
+
+    def test_sync_manifest(self):
+        manifest = os.path.join(settings.TEMP, 'cbs3testmanifest.json')
+        self.sync(hash=True, manifest=manifest)
+        fh = open(manifest)
+        self.assertEqual(
+            sorted(json.load(fh).keys()),
+            sorted(os.path.join(self.folder, file) for file in self.files.keys())
+        )
+        fh.close()
+        modified_times = self.get_modified_times()
+        sleep(1)
+        self.sync(hash=True, manifest=manifest)
+        self.assertEqual(self.get_modified_times(), modified_times)
+        os.remove(manifest)
+        for file in self.files.keys():
+            default_storage.delete(os.path.join(self.folder, file))
+
+    def test_sync_workers(self):
+        self.sync(workers=3)
+        for file in self.files.keys():
+            self.assert_(default_storage.exists(os.path.join(self.folder, file)))
+        modified_times = self.get_modified_times()
+        self.sync(workers=3, list=True)
+        self.assertEqual(self.get_modified_times(), modified_times)
+        for file in self.files.keys():
+            default_storage.delete(os.path.join(self.folder, file))
+
 
 class MediaMonkeyPatchTest(TestCase):
     def test_media_monkey_patch(self):